@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+"""
+Deterministic synthetic fastqs and FastQC reports for benchmarks.
+
+usage:
+    generate.py fastq [options] <out>
+    generate.py fastqc [options] <out>
+
+options:
+  -h --help               Show this screen.
+  --reads=<N>             Number of reads [default: 100000]
+  --header=<format>       illumina, legacy, srr or pacbio [default: illumina]
+  --length=<min:max>      Read length range (format default if omitted)
+  --duplication=<frac>    Fraction of reads repeating an earlier read [default: 0.2]
+  --gzip                  Write gzip
+  --rows=<N>              Rows in overrepresented sequence and kmer tables [default: 500]
+  --seed=<seed>           Random seed [default: 1]
+
+"""
+from docopt import docopt
+from gzip import GzipFile
+import random
+
+header_formats = ["illumina", "legacy", "srr", "pacbio"]
+
+# Read length range of each header format.
+default_lengths = {"illumina": (100, 150),
+                   "legacy": (36, 76),
+                   "srr": (50, 100),
+                   "pacbio": (1000, 5000)}
+
+# Reads are sliced from a random "genome" and quality string,
+# so generating them needs little work per base.
+POOL_SIZE = 1024 * 1024
+
+
+def _pool(rng, alphabet, size=POOL_SIZE):
+    return "".join([rng.choice(alphabet) for i in xrange(size)])
+
+
+def _header(rng, fmt, i, length, barcodes):
+    if fmt == "illumina":
+        return "@D00422:191:HBDWCADXX:%d:%d:%d:%d 1:N:0:%s" % (
+            rng.randint(1, 8), rng.randint(1101, 1116),
+            rng.randint(1000, 20000), rng.randint(1000, 100000),
+            rng.choice(barcodes))
+    elif fmt == "legacy":
+        return "@HWUSI-EAS100R:%d:%d:%d:%d#%s/1" % (
+            rng.randint(1, 8), rng.randint(1, 120),
+            rng.randint(0, 2000), rng.randint(0, 2000),
+            rng.choice(barcodes))
+    elif fmt == "srr":
+        return "@SRR001666.%d %d length=%d" % (i, i, length)
+    elif fmt == "pacbio":
+        return "@m54006_160504_020705/%d/0_%d" % (i, length)
+    raise ValueError("Unknown header format: " + fmt)
+
+
+def fastq_records(reads, fmt="illumina", lengths=None, duplication=0.2, seed=1):
+    """
+        Yield synthetic fastq records. The same arguments
+        always give the same records.
+    """
+    rng = random.Random(seed)
+    min_length, max_length = lengths or default_lengths[fmt]
+    genome = _pool(rng, "ACGT" * 50 + "N")
+    quals = _pool(rng, "".join(map(chr, range(35, 75))))
+    # A few barcodes dominate, as in a demultiplexed lane.
+    barcodes = ["".join(rng.choice("ACGT") for x in range(8)) for y in range(16)]
+    barcodes = barcodes[:1] * 48 + barcodes
+    recent = []
+    for i in xrange(reads):
+        if recent and rng.random() < duplication:
+            seq = rng.choice(recent)
+        else:
+            length = rng.randint(min_length, max_length)
+            start = rng.randint(0, len(genome) - length)
+            seq = genome[start:start + length]
+            if len(recent) < 1000:
+                recent.append(seq)
+            else:
+                recent[rng.randrange(1000)] = seq
+        start = rng.randint(0, len(quals) - len(seq))
+        yield "%s\n%s\n+\n%s\n" % (_header(rng, fmt, i + 1, len(seq), barcodes),
+                                  seq,
+                                  quals[start:start + len(seq)])
+
+
+def write_fastq(out, reads, fmt="illumina", lengths=None, duplication=0.2,
+                compress=False, seed=1):
+    """
+        Write a synthetic fastq (gzipped if `compress`) and
+        return its path.
+    """
+    with open(out, 'wb') as raw:
+        # No name or timestamp, so gzip output is reproducible.
+        f = GzipFile(filename="", fileobj=raw, mtime=0) if compress else raw
+        for record in fastq_records(reads, fmt, lengths, duplication, seed):
+            f.write(record)
+        if compress:
+            f.close()
+    return out
+
+
+def write_fastqc(out, rows=500, length=150, seed=1):
+    """
+        Write a synthetic fastqc_data.txt with every module
+        parsed by parse_fastqc and return its path.
+    """
+    rng = random.Random(seed)
+    modules = [("Per base sequence quality", "#Base\tMean\tMedian\tLower Quartile\tUpper Quartile\t10th Percentile\t90th Percentile",
+                [[pos, rng.uniform(20, 40), 38, 32, 40, 25, 41] for pos in range(1, length + 1)]),
+               ("Per tile sequence quality", "#Tile\tBase\tMean",
+                [[tile, pos, rng.uniform(-2, 2)] for tile in range(1101, 1117)
+                 for pos in range(1, length + 1, 10)]),
+               ("Per sequence quality scores", "#Quality\tCount",
+                [[q, rng.randint(0, 10 ** 6)] for q in range(2, 42)]),
+               ("Per base sequence content", "#Base\tG\tA\tT\tC",
+                [[pos] + [rng.uniform(20, 30) for x in "GATC"] for pos in range(1, length + 1)]),
+               ("Per sequence GC content", "#GC Content\tCount",
+                [[gc, rng.uniform(0, 10 ** 5)] for gc in range(101)]),
+               ("Per base N content", "#Base\tN-Count",
+                [[pos, rng.uniform(0, 1)] for pos in range(1, length + 1)]),
+               ("Sequence Length Distribution", "#Length\tCount",
+                [[n, rng.randint(0, 10 ** 5)] for n in range(length - 50, length + 1)]),
+               ("Sequence Duplication Levels", "#Duplication Level\tPercentage of deduplicated\tPercentage of total",
+                [[level, rng.uniform(0, 100), rng.uniform(0, 100)] for level in
+                 map(str, range(1, 10)) + [">10", ">50", ">100", ">500", ">1k", ">5k", ">10k+"]]),
+               ("Overrepresented sequences", "#Sequence\tCount\tPercentage\tPossible Source",
+                [["".join(rng.choice("ACGT") for x in range(50)), rng.randint(100, 10 ** 5),
+                  rng.uniform(0, 1), "No Hit"] for row in range(rows)]),
+               ("Adapter Content", "#Position\tIllumina Universal Adapter\tIllumina Small RNA 3' Adapter\tIllumina Small RNA 5' Adapter\tNextera Transposase Sequence\tSOLID Small RNA Adapter",
+                [[pos] + [rng.uniform(0, 1) for x in range(5)] for pos in range(1, length + 1)]),
+               ("Kmer Content", "#Sequence\tCount\tPValue\tObs/Exp Max\tMax Obs/Exp Position",
+                [["".join(rng.choice("ACGT") for x in range(7)), rng.randint(100, 10 ** 4),
+                  0.0, rng.uniform(5, 50), rng.randint(1, length)] for row in range(rows)])]
+    with open(out, 'w') as f:
+        f.write("##FastQC\t0.11.5\n")
+        f.write(">>Basic Statistics\tpass\n#Measure\tValue\n")
+        f.write("Filename\tbench.fq.gz\nFile type\tConventional base calls\n")
+        f.write("Encoding\tSanger / Illumina 1.9\nTotal Sequences\t1000000\n")
+        f.write("Sequences flagged as poor quality\t0\n")
+        f.write("Sequence length\t%d\n%%GC\t48\n>>END_MODULE\n" % length)
+        for name, header, table in modules:
+            f.write(">>%s\t%s\n%s\n" % (name, rng.choice(["pass", "warn", "fail"]), header))
+            for row in table:
+                f.write("\t".join(map(str, row)) + "\n")
+            f.write(">>END_MODULE\n")
+    return out
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    seed = int(args["--seed"])
+    if args["fastq"]:
+        lengths = None
+        if args["--length"]:
+            lengths = map(int, args["--length"].split(":"))
+        write_fastq(args["<out>"],
+                    int(args["--reads"]),
+                    args["--header"],
+                    lengths,
+                    float(args["--duplication"]),
+                    args["--gzip"],
+                    seed)
+    else:
+        write_fastqc(args["<out>"], int(args["--rows"]), seed=seed)
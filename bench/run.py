@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+"""
+Benchmark hashing, sniffing, profiling and FastQC parsing on
+synthetic files, optionally comparing with a stored baseline.
+
+usage:
+    run.py [options]
+    run.py phase <phase> <file>
+
+options:
+  -h --help               Show this screen.
+  --reads=<N,...>         Read counts of the generated fastqs [default: 20000,200000]
+  --headers=<formats>     Header formats [default: illumina,legacy,srr,pacbio]
+  --phases=<phases>       Phases to run [default: md5sum,sniff,stats,scan,parse_fastqc]
+  --repeat=<N>            Runs of each phase; the fastest is kept [default: 3]
+  --dir=<dir>             Where generated files are kept [default: bench/data]
+  --baseline=<file>       Baseline to compare with [default: bench/baseline.json]
+  --save-baseline         Store these results as the baseline
+  --threshold=<percent>   Slowdown reported as a regression [default: 10]
+  --json                  Output results as JSON lines
+
+Every phase runs in a new interpreter, so peak RSS is its own.
+Exits with status 1 if any phase regressed from the baseline.
+
+"""
+from docopt import docopt
+from subprocess import Popen, PIPE
+import hashlib
+import json
+import os
+import resource
+import sys
+import time
+
+# Benchmark the fq package of this checkout.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from generate import write_fastq, write_fastqc
+from fq import fqprofile, parse_fastqc
+from fq.fq_util import fastq_reader, scan_fastq
+
+# Peak RSS in MB (ru_maxrss is in bytes on OS X, KB elsewhere).
+RSS_UNIT = 1024.0 * 1024 if sys.platform == "darwin" else 1024.0
+
+
+def run_phase(phase, filename):
+    """
+        Run one phase on a file and return the number of
+        reads it saw (None if it does not count reads).
+    """
+    if phase == "md5sum":
+        # No progress bar.
+        fqprofile.messages = []
+        fqprofile.md5sum(filename)
+    elif phase == "sniff":
+        fastq_reader(filename)
+    elif phase == "stats":
+        return fastq_reader(filename).calculate_fastq_stats()["total_reads"]
+    elif phase == "scan":
+        return scan_fastq(filename, digests=[hashlib.md5()])[1]["total_reads"]
+    elif phase == "parse_fastqc":
+        parse_fastqc(filename)
+    else:
+        raise ValueError("Unknown phase: " + phase)
+
+
+def measure(phase, filename):
+    # Run a phase in a new interpreter.
+    out, err = Popen([sys.executable, os.path.abspath(__file__),
+                      "phase", phase, filename],
+                     stdout=PIPE, stderr=PIPE).communicate()
+    try:
+        return json.loads(out)
+    except ValueError:
+        raise RuntimeError("Phase {phase} failed on {filename}:\n{err}".format(**locals()))
+
+
+def datasets(args):
+    """
+        Generate (or reuse) the benchmark files and return
+        a list of (name, path, kind).
+    """
+    if not os.path.exists(args["--dir"]):
+        os.makedirs(args["--dir"])
+    files = []
+    for fmt in args["--headers"].split(","):
+        for reads in map(int, args["--reads"].split(",")):
+            if fmt == "pacbio":
+                # Long reads; keep the file sizes comparable.
+                reads = max(reads // 30, 1)
+            for compress in (False, True):
+                name = "{fmt}_{reads}{ext}".format(fmt=fmt,
+                                                   reads=reads,
+                                                   ext=".fq.gz" if compress else ".fq")
+                path = os.path.join(args["--dir"], name)
+                if not os.path.exists(path):
+                    write_fastq(path + ".tmp", reads, fmt, compress=compress)
+                    os.rename(path + ".tmp", path)
+                files.append((name, path, "fastq"))
+    path = os.path.join(args["--dir"], "fastqc_data.txt")
+    if not os.path.exists(path):
+        write_fastqc(path)
+    files.append(("fastqc_data.txt", path, "fastqc"))
+    return files
+
+
+def compare(result, baseline, threshold):
+    # Percent change in MB/s from the baseline.
+    base = baseline.get(result["file"] + "\t" + result["phase"])
+    if not base:
+        return None, ""
+    change = (result["mb_per_s"] / base["mb_per_s"] - 1) * 100
+    if change < -threshold:
+        return change, "REGRESSION"
+    elif change > threshold:
+        return change, "faster"
+    return change, ""
+
+
+def main():
+    args = docopt(__doc__)
+    if args["phase"]:
+        start = time.time()
+        reads = run_phase(args["<phase>"], args["<file>"])
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print json.dumps({"seconds": time.time() - start,
+                          "reads": reads,
+                          "peak_rss_mb": usage.ru_maxrss / RSS_UNIT})
+        return
+
+    baseline = {}
+    if os.path.exists(args["--baseline"]) and not args["--save-baseline"]:
+        baseline = json.load(open(args["--baseline"]))
+    threshold = float(args["--threshold"])
+    phases = args["--phases"].split(",")
+    results = []
+    regressions = 0
+    if not args["--json"]:
+        print "\t".join(["file", "phase", "MB", "seconds", "MB/s",
+                         "reads/s", "peak_rss_mb", "vs_baseline"])
+    for name, path, kind in datasets(args):
+        for phase in phases:
+            if (kind == "fastqc") != (phase == "parse_fastqc"):
+                continue
+            runs = [measure(phase, path) for i in range(int(args["--repeat"]))]
+            best = min(runs, key=lambda x: x["seconds"])
+            seconds = max(best["seconds"], 1e-6)
+            mb = os.path.getsize(path) / 1024.0 / 1024.0
+            result = {"file": name,
+                      "phase": phase,
+                      "mb": mb,
+                      "seconds": seconds,
+                      "mb_per_s": mb / seconds,
+                      "reads_per_s": best["reads"] / seconds if best["reads"] else None,
+                      "peak_rss_mb": max(x["peak_rss_mb"] for x in runs)}
+            change, flag = compare(result, baseline, threshold)
+            result["vs_baseline"] = change
+            regressions += flag == "REGRESSION"
+            results.append(result)
+            if args["--json"]:
+                print json.dumps(result)
+            else:
+                print "\t".join([name,
+                                 phase,
+                                 "%.1f" % mb,
+                                 "%.3f" % seconds,
+                                 "%.1f" % result["mb_per_s"],
+                                 "%.0f" % result["reads_per_s"] if best["reads"] else "",
+                                 "%.1f" % result["peak_rss_mb"],
+                                 "%+.1f%% %s" % (change, flag) if change is not None else ""])
+            sys.stdout.flush()
+    if args["--save-baseline"]:
+        with open(args["--baseline"], 'w') as f:
+            json.dump(dict((x["file"] + "\t" + x["phase"], x) for x in results),
+                      f, indent=4, sort_keys=True)
+    if regressions:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+"""
+Benchmark the startup time of fq commands, optionally comparing
+with a stored baseline.
+
+usage:
+    startup.py [options]
+
+options:
+  -h --help               Show this screen.
+  --repeat=<N>            Runs of each command; the fastest is kept [default: 10]
+  --baseline=<file>       Baseline to compare with [default: bench/startup_baseline.json]
+  --save-baseline         Store these results as the baseline
+  --threshold=<percent>   Slowdown reported as a regression [default: 10]
+
+Commands run against a copy of the fq package with its own settings
+and an empty SQLite database, so the real settings are untouched.
+Exits with status 1 if any command regressed from the baseline.
+
+"""
+from docopt import docopt
+from subprocess import Popen, PIPE
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+package = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fq")
+
+# Run fq from the copied package.
+fq_main = "import sys; sys.argv = ['fq'] + sys.argv[1:]; from fq.fqprofile import main; main()"
+
+commands = [["--version"],
+            ["--help"],
+            ["not-a-command"],
+            ["set", "bench", "fastq", "--backend=sqlite", "--db={tmp}/bench.db"],
+            ["query", "total_reads>1"],
+            ["dump", "--format=tsv"],
+            ["summary"]]
+
+
+def run_time(cmd, tmp):
+    # Wall time of one process.
+    env = dict(os.environ, PYTHONPATH=tmp)
+    start = time.time()
+    Popen(cmd, stdout=PIPE, stderr=PIPE, env=env, cwd=tmp).communicate()
+    return time.time() - start
+
+
+def fq_time(tmp, command):
+    return run_time([sys.executable, "-c", fq_main] +
+                    [x.format(tmp=tmp) for x in command], tmp)
+
+
+def main():
+    args = docopt(__doc__)
+    tmp = tempfile.mkdtemp(prefix="fq_startup")
+    try:
+        shutil.copytree(package, os.path.join(tmp, "fq"),
+                        ignore=shutil.ignore_patterns("*.pyc", ".config",
+                                                      ".checksum.db", ".checkpoints"))
+        # Settings used by the commands after `set`.
+        fq_time(tmp, commands[3])
+        repeat = int(args["--repeat"])
+        # Python startup alone, for reference.
+        results = {"python": min(run_time([sys.executable, "-c", "pass"], tmp)
+                                 for i in range(repeat))}
+        for command in commands:
+            results[command[0]] = min(fq_time(tmp, command) for i in range(repeat))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args["--baseline"]) and not args["--save-baseline"]:
+        baseline = json.load(open(args["--baseline"]))
+    threshold = float(args["--threshold"])
+    regressions = 0
+    print "\t".join(["command", "ms", "vs_baseline"])
+    # Python itself is shown for reference, not compared.
+    for command in ["python"] + [x[0] for x in commands]:
+        ms = results[command] * 1000
+        change = ""
+        if command in baseline and command != "python":
+            pct = (ms / baseline[command] - 1) * 100
+            flag = ""
+            if pct > threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            elif pct < -threshold:
+                flag = "faster"
+            change = "%+.1f%% %s" % (pct, flag)
+        print "\t".join([command, "%.1f" % ms, change])
+    if args["--save-baseline"]:
+        with open(args["--baseline"], 'w') as f:
+            json.dump(dict((k, v * 1000) for k, v in results.items()),
+                      f, indent=4, sort_keys=True)
+    if regressions:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
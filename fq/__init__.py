@@ -1,14 +1,7 @@
 __version__ = "0.0.5"
 from datetime import datetime
-from clint.textui import colored, puts_err
 import os
 
-try:
-    from dateutil.parser import parse
-except:
-    pass
-
-
 
 def boolify(s):
     if s == 'True':
@@ -25,6 +18,7 @@ def autoconvert(s):
         except ValueError:
             pass
     if type(s) is str and s.startswith("date-"):
+        from dateutil.parser import parse
         s = parse(s.replace("date-", ""))
     return s
 
@@ -39,19 +33,31 @@ def json_serial(obj):
 
 
 def parse_fastqc(fqc):
-    d = [x.strip().split("\t") for x in open(fqc, 'r').readlines()]
+    """
+        Parse fastqc_data.txt, given a filename or file object.
+        Module tables are stored as packed, typed columns named
+        by fastqc_headers.
+    """
+    from fq.fastqc_table import pack_table
+    if isinstance(fqc, basestring):
+        fqc = open(fqc, 'r')
     out = {}
     table_group = None
-    table_out = ""
-    for line in d:
+    table_header = []
+    table_rows = []
+    for line in fqc:
+        line = line.strip().split("\t")
         if line[0].startswith("##FastQC"):
             out['fastqc_version'] = autoconvert(line[1])
-        elif line[0] == ">>END_MODULE" and table_group == "basic_statistics" or line[0].startswith("#"):
+        elif line[0] == ">>END_MODULE" and table_group == "basic_statistics":
             pass
+        elif line[0].startswith("#"):
+            # Column names, used if the module has no fastqc_headers entry.
+            table_header = [x.strip("#").lower().replace(" ", "_") for x in line]
         elif line[0] == ">>END_MODULE" and table_group:
-            out["fastqc_" + table_group + "_data"] = table_out
+            columns = fastqc_headers.get(table_group, table_header)
+            out["fastqc_" + table_group + "_data"] = pack_table(columns, table_rows)
             table_group = None
-            table_out = ""
         # Pass QC
         elif line[0].startswith(">>"):
             k = line[0].lower() \
@@ -59,6 +65,8 @@ def parse_fastqc(fqc):
                        .strip(">")
             out[k] = line[1]
             table_group = k
+            table_header = []
+            table_rows = []
         elif line[0] in ["Encoding",
                          "Sequences flagged as poor quality",
                          "Sequence length",
@@ -68,7 +76,7 @@ def parse_fastqc(fqc):
                        .replace("%gc", "GC_content")
             out["fastqc_" + k] = autoconvert(line[1])
         elif table_group:
-            table_out += '\t'.join(line) + "\n"
+            table_rows.append(map(autoconvert, line))
 
     return(out)
 
@@ -93,6 +101,7 @@ def which(program):
 
 
 def check_program_exists(program):
+    from clint.textui import colored, puts_err
     if which(program) is None:
         exit(puts_err(colored.red("\nError: " + program + " not installed or on PATH.\n")))
 
@@ -122,7 +131,7 @@ fastqc_headers = {'per_base_sequence_quality': ["base",
                   'per_sequence_gc_content': ["gc_content", "count"],
                   'per_base_n_content': ["base", "n_count"],
                   'sequence_length_distribution': ["length", "count"],
-                  'sequence_duplications_levels': ["duplication_level",
+                  'sequence_duplication_levels': ["duplication_level",
                                                    "percentage_of_deduplicated",
                                                    "percentage_of_total"],
                   'overrepresented_sequences': ["sequence",
@@ -0,0 +1,308 @@
+# Storage backends. Each backend offers the subset of the
+# gcloud datastore client used by fq: key, entity, get,
+# get_multi, put_multi, transaction and query.
+from base64 import b64decode, b64encode
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+
+
+class blob(str):
+    # Binary property value (e.g. packed FastQC tables).
+    pass
+
+
+class datastore_backend:
+    # Google Datastore
+    def __init__(self, project, client=None):
+        from gcloud import datastore
+        from gcloud.exceptions import Conflict, ServerError, TooManyRequests
+        import httplib
+        import socket
+        self.datastore = datastore
+        if client is None:
+            client = datastore.Client(project=project)
+        self.client = client
+        # Errors worth retrying: contention, rate limiting,
+        # server errors and dropped connections.
+        self.transient_errors = (Conflict, TooManyRequests, ServerError,
+                                 httplib.HTTPException, socket.error)
+
+    def key(self, kind, name):
+        return self.client.key(kind, name)
+
+    def entity(self, key, exclude_from_indexes=()):
+        return self.datastore.Entity(key=key,
+                                     exclude_from_indexes=exclude_from_indexes)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_multi(self, keys, deferred=None):
+        return self.client.get_multi(keys, deferred=deferred)
+
+    def put_multi(self, entities):
+        self.client.put_multi(entities)
+
+    def transaction(self):
+        # Reads and writes within are committed together, or
+        # raise Conflict if the entities read changed meanwhile.
+        return self.client.transaction()
+
+    def _query(self, kind, filters=None, projection=()):
+        # filters:
+        # [("var_name", "=", 1)]
+        query = self.client.query(kind=kind, projection=projection)
+        if filters:
+            for var, op, val in filters:
+                query.add_filter(var, op, val)
+        return query
+
+    def query(self, kind, filters=None, projection=()):
+        return self._query(kind, filters, projection).fetch()
+
+    def query_pages(self, kind, filters=None, page_size=100):
+        """
+            Yield lists of at most page_size entities,
+            following the query cursor between pages.
+        """
+        from gcloud.datastore.helpers import entity_from_protobuf
+        cursor = None
+        while True:
+            query = self._query(kind, filters)
+            results, more_results, cursor = query.fetch(limit=page_size,
+                                                        start_cursor=cursor).next_page()
+            page = [x if isinstance(x, self.datastore.Entity)
+                    else entity_from_protobuf(x) for x in results]
+            if page:
+                yield page
+            # Datastore may end a batch short of the limit (more_results
+            # is NOT_FINISHED). A batch that reached the limit is reported
+            # as finished by gcloud, so the next page is asked for as well.
+            if not cursor or not (more_results or len(page) == page_size):
+                break
+
+
+class local_key:
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+
+class local_entity(dict):
+    def __init__(self, key, exclude_from_indexes=()):
+        dict.__init__(self)
+        self.key = key
+        self.exclude_from_indexes = set(exclude_from_indexes)
+
+
+def _encode(obj):
+    if isinstance(obj, datetime):
+        return {"__datetime__": obj.strftime("%Y-%m-%dT%H:%M:%S.%f")}
+    raise TypeError("Type not serializable")
+
+
+def _decode(obj):
+    if "__datetime__" in obj:
+        return datetime.strptime(obj["__datetime__"], "%Y-%m-%dT%H:%M:%S.%f")
+    elif "__blob__" in obj:
+        return blob(b64decode(obj["__blob__"]))
+    return obj
+
+
+def _dumps(m):
+    # Binary values are base64 encoded within the JSON.
+    data = {}
+    for k, v in m.items():
+        if isinstance(v, blob):
+            v = {"__blob__": b64encode(v)}
+        data[k] = v
+    return json.dumps(data, default=_encode)
+
+
+def _index_value(value):
+    # Dates are indexed as sortable ISO strings.
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    return value
+
+
+class sqlite_backend:
+    """
+        Embedded SQLite store. Entities are stored as JSON and every
+        indexed scalar property (and each element of list properties)
+        is written to a secondary index used by queries.
+    """
+    # Locks are waited on by sqlite3 itself (timeout).
+    transient_errors = ()
+
+    def __init__(self, db):
+        db_dir = os.path.dirname(os.path.abspath(db))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        import sqlite3
+        self.db = sqlite3.connect(db, timeout=60)
+        self.in_transaction = False
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entity (kind TEXT,
+                                               name TEXT,
+                                               data TEXT,
+                                               exclude TEXT,
+                                               PRIMARY KEY (kind, name));
+            CREATE TABLE IF NOT EXISTS property (kind TEXT,
+                                                 name TEXT,
+                                                 prop TEXT,
+                                                 value);
+            CREATE INDEX IF NOT EXISTS property_value ON property (kind, prop, value);
+            CREATE INDEX IF NOT EXISTS property_name ON property (kind, name);
+        """)
+
+    def key(self, kind, name):
+        return local_key(kind, name)
+
+    def entity(self, key, exclude_from_indexes=()):
+        return local_entity(key, exclude_from_indexes)
+
+    def _load(self, kind, name, data, exclude):
+        m = local_entity(local_key(kind, name), json.loads(exclude))
+        m.update(json.loads(data, object_hook=_decode))
+        return m
+
+    def get(self, key):
+        items = self.get_multi([key])
+        if items:
+            return items[0]
+
+    def get_multi(self, keys, deferred=None):
+        items = []
+        for key in keys:
+            row = self.db.execute("SELECT data, exclude FROM entity WHERE kind = ? AND name = ?",
+                                  (key.kind, key.name)).fetchone()
+            if row:
+                items.append(self._load(key.kind, key.name, *row))
+        return items
+
+    @contextmanager
+    def transaction(self):
+        """
+            Run reads and writes as one transaction that takes the
+            write lock before the first read (BEGIN IMMEDIATE), so that
+            a read-modify-write is not interleaved with other writers.
+        """
+        self.db.commit()
+        # Transactions are begun and committed here, not by sqlite3.
+        self.db.isolation_level = None
+        self.db.execute("BEGIN IMMEDIATE")
+        self.in_transaction = True
+        try:
+            yield
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        else:
+            self.db.execute("COMMIT")
+        finally:
+            self.in_transaction = False
+            self.db.isolation_level = ""
+
+    def put_multi(self, entities):
+        if self.in_transaction:
+            self._put_multi(entities)
+        else:
+            with self.db:
+                self._put_multi(entities)
+
+    def _put_multi(self, entities):
+        for m in entities:
+            kind, name = m.key.kind, m.key.name
+            self.db.execute("INSERT OR REPLACE INTO entity VALUES (?, ?, ?, ?)",
+                            (kind, name,
+                             _dumps(m),
+                             json.dumps(sorted(m.exclude_from_indexes))))
+            self.db.execute("DELETE FROM property WHERE kind = ? AND name = ?",
+                            (kind, name))
+            rows = []
+            for prop, value in m.items():
+                if prop in m.exclude_from_indexes:
+                    continue
+                if type(value) != list:
+                    value = [value]
+                for v in value:
+                    if isinstance(v, blob):
+                        continue
+                    if isinstance(v, (basestring, int, long, float, datetime)):
+                        rows.append((kind, name, prop, _index_value(v)))
+            self.db.executemany("INSERT INTO property VALUES (?, ?, ?, ?)", rows)
+
+    def _query(self, kind, filters=None, projection=(), cursor=None, limit=None):
+        sql = "SELECT name, data, exclude FROM entity WHERE kind = ?"
+        params = [kind]
+        for var, op, val in filters or []:
+            if op not in ("=", "<", ">", "<=", ">=", "!="):
+                raise ValueError("Unsupported operator: " + op)
+            sql += (" AND name IN (SELECT name FROM property"
+                    " WHERE kind = ? AND prop = ? AND value {op} ?)").format(op=op)
+            params += [kind, var, _index_value(val)]
+        for var in projection:
+            sql += " AND name IN (SELECT name FROM property WHERE kind = ? AND prop = ?)"
+            params += [kind, var]
+        if cursor is not None:
+            sql += " AND name > ?"
+            params.append(cursor)
+        sql += " ORDER BY name"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for name, data, exclude in self.db.execute(sql, params):
+            m = self._load(kind, name, data, exclude)
+            if projection:
+                for var in m.keys():
+                    if var not in projection:
+                        del m[var]
+            yield m
+
+    def query(self, kind, filters=None, projection=()):
+        return self._query(kind, filters, projection)
+
+    def query_pages(self, kind, filters=None, page_size=100):
+        """
+            Yield lists of at most page_size entities. Pages
+            continue from the last name of the previous page.
+        """
+        cursor = None
+        while True:
+            page = list(self._query(kind, filters, cursor=cursor, limit=page_size))
+            if page:
+                yield page
+            if len(page) < page_size:
+                break
+            cursor = page[-1].key.name
+
+
+def open_backend(settings):
+    """
+        Open the backend named in settings.
+    """
+    backend = settings.get("backend", "datastore")
+    if backend == "sqlite":
+        return sqlite_backend(settings["db"])
+    elif backend == "datastore":
+        return datastore_backend(settings["project"])
+    raise ValueError("Unknown backend: " + backend)
+
+
+class lazy_backend:
+    """
+        Backend opened on first use, so that commands which
+        never reach storage do not import gcloud or connect.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.backend = None
+
+    def __getattr__(self, name):
+        if self.__dict__.get("backend") is None:
+            self.backend = open_backend(self.settings)
+        return getattr(self.backend, name)
@@ -0,0 +1,255 @@
+# On-disk cache of entities and query results (--cache-ttl).
+from fq.backend import local_entity, local_key
+import cPickle as pickle
+import os
+import time
+import uuid
+
+ENTITY, QUERY = "entity", "query"
+
+
+def _dumps(m):
+    return pickle.dumps((m.key.name,
+                         dict(m),
+                         sorted(getattr(m, "exclude_from_indexes", ()))),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(kind, data):
+    name, properties, exclude = pickle.loads(str(data))
+    m = local_entity(local_key(kind, name), exclude)
+    m.update(properties)
+    return m
+
+
+class cache_miss(Exception):
+    """
+        Cached query results evicted while they were being read.
+    """
+
+
+def query_key(filters=None, projection=()):
+    """
+        Normalized filter set and projection of a query,
+        so that the same filters in any order share an entry.
+    """
+    return repr((sorted(map(tuple, filters or ())), sorted(projection)))
+
+
+class entity_cache:
+    """
+        Cache of entities, keyed by name, and of query results,
+        keyed by normalized filter set, stored in SQLite. Entries
+        expire `ttl` seconds after they were fetched, and the least
+        recently used are evicted beyond `max_size` bytes. Cached
+        entities are local_entity objects, so a cache hit does not
+        open the backend. Entries are kept per `store` (the backend,
+        project and kind).
+
+        Query results are written a page at a time as they are
+        read, and read back a page at a time, so neither holds
+        more than a page in memory. The entry of a query refers
+        to its pages and is only added once every page is written.
+
+        Writes made here invalidate entries through `invalidate`,
+        which works even when reads are disabled (ttl of 0).
+        Writes made elsewhere are seen once entries expire.
+    """
+
+    def __init__(self, filename, store, ttl=3600, max_size=256 * 1024 * 1024):
+        self.filename = filename
+        self.store = store
+        self.ttl = ttl
+        self.max_size = max_size
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            import sqlite3
+            self.db = sqlite3.connect(self.filename, timeout=60)
+            self.db.text_factory = str
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS cache (store TEXT,
+                                                  kind TEXT,
+                                                  type TEXT,
+                                                  key TEXT,
+                                                  data BLOB,
+                                                  size INTEGER,
+                                                  created REAL,
+                                                  accessed REAL,
+                                                  PRIMARY KEY (store, kind, type, key));
+                CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+                CREATE TABLE IF NOT EXISTS page (token TEXT,
+                                                 n INTEGER,
+                                                 store TEXT,
+                                                 kind TEXT,
+                                                 query TEXT,
+                                                 data BLOB,
+                                                 created REAL,
+                                                 PRIMARY KEY (token, n));
+                CREATE INDEX IF NOT EXISTS page_query ON page (store, kind, query);
+            """)
+        return self.db
+
+    def _get(self, kind, type, keys):
+        # Return {key: data} for unexpired entries, marking them used.
+        if not self.ttl or not keys:
+            return {}
+        db = self._connect()
+        now = time.time()
+        found = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = db.execute("SELECT key, data FROM cache WHERE store = ? AND kind = ? "
+                              "AND type = ? AND created > ? AND key IN (%s)" %
+                              ",".join("?" * len(batch)),
+                              [self.store, kind, type, now - self.ttl] + batch)
+            found.update(rows)
+        if found:
+            with db:
+                db.executemany("UPDATE cache SET accessed = ? WHERE store = ? AND kind = ? "
+                               "AND type = ? AND key = ?",
+                               [(now, self.store, kind, type, key) for key in found])
+        return found
+
+    def _put(self, kind, type, items):
+        # Store (key, data) items, then evict to max_size.
+        items = [(key, data) for key, data in items if len(data) <= self.max_size]
+        if not self.ttl or not items:
+            return
+        db = self._connect()
+        now = time.time()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(self.store, kind, type, key, buffer(data), len(data), now, now)
+                            for key, data in items])
+            self._evict(db, now)
+
+    def _evict(self, db, now):
+        # Drop expired entries, then the least recently used beyond
+        # max_size, then pages no longer referred to. Pages of a
+        # query still being written expire like entries.
+        db.execute("DELETE FROM cache WHERE created <= ?", (now - self.ttl,))
+        db.execute("DELETE FROM page WHERE created <= ?", (now - self.ttl,))
+        size = db.execute("SELECT SUM(size) FROM cache").fetchone()[0] or 0
+        if size > self.max_size:
+            evicted = 0
+            cutoff = None
+            for accessed, entry_size in db.execute("SELECT accessed, size FROM cache "
+                                                   "ORDER BY accessed"):
+                evicted += entry_size
+                cutoff = accessed
+                if size - evicted <= self.max_size:
+                    break
+            db.execute("DELETE FROM cache WHERE accessed <= ?", (cutoff,))
+        db.execute("DELETE FROM page WHERE query IS NOT NULL AND NOT EXISTS "
+                   "(SELECT 1 FROM cache WHERE cache.store = page.store AND "
+                   "cache.kind = page.kind AND cache.type = ? AND cache.key = page.query)",
+                   (QUERY,))
+
+    def get_entities(self, kind, names):
+        """
+            Return {name: entity} for the cached entities of `names`.
+        """
+        found = self._get(kind, ENTITY, list(set(names)))
+        return dict((name, _loads(kind, data)) for name, data in found.items())
+
+    def put_entities(self, kind, entities):
+        self._put(kind, ENTITY, [(m.key.name, _dumps(m)) for m in entities])
+
+    def invalidate(self, kind, names=None):
+        """
+            Drop cached query results of a kind and the cached
+            entities of `names` (every entity if None).
+        """
+        if not os.path.exists(self.filename) and self.db is None:
+            return
+        db = self._connect()
+        with db:
+            # Pages being written are dropped too, so that results
+            # read before the writes are not cached.
+            db.execute("DELETE FROM page WHERE store = ? AND kind = ?",
+                       (self.store, kind))
+            if names is None:
+                db.execute("DELETE FROM cache WHERE store = ? AND kind = ?",
+                           (self.store, kind))
+                return
+            db.execute("DELETE FROM cache WHERE store = ? AND kind = ? AND type = ?",
+                       (self.store, kind, QUERY))
+            db.executemany("DELETE FROM cache WHERE store = ? AND kind = ? AND type = ? AND key = ?",
+                           [(self.store, kind, ENTITY, name) for name in set(names)])
+
+    def get_pages(self, kind, filters=None, projection=()):
+        """
+            Return an iterator over the cached pages of a query,
+            or None. Raises cache_miss if pages are evicted while
+            they are read.
+        """
+        key = query_key(filters, projection)
+        found = self._get(kind, QUERY, [key])
+        if key not in found:
+            return None
+        token, count = pickle.loads(str(found[key]))
+        return self._read_pages(kind, token, count)
+
+    def _read_pages(self, kind, token, count):
+        db = self._connect()
+        for n in range(count):
+            row = db.execute("SELECT data FROM page WHERE token = ? AND n = ?",
+                             (token, n)).fetchone()
+            if row is None:
+                raise cache_miss(kind)
+            yield [_loads(kind, data) for data in pickle.loads(str(row[0]))]
+
+    def cache_pages(self, kind, pages, filters=None, projection=()):
+        """
+            Yield pages of query results, writing each to the
+            cache as it is read. Results are cached once every
+            page is written, unless they exceed max_size.
+        """
+        if not self.ttl:
+            for page in pages:
+                yield page
+            return
+        db = self._connect()
+        token = uuid.uuid4().hex
+        count = 0
+        size = 0
+        try:
+            for page in pages:
+                if token:
+                    data = pickle.dumps(map(_dumps, page), pickle.HIGHEST_PROTOCOL)
+                    size += len(data)
+                    if size > self.max_size:
+                        self._drop_pages(token)
+                        token = None
+                    else:
+                        with db:
+                            db.execute("INSERT INTO page VALUES (?, ?, ?, ?, NULL, ?, ?)",
+                                       (token, count, self.store, kind, buffer(data),
+                                        time.time()))
+                        count += 1
+                yield page
+            if token:
+                key = query_key(filters, projection)
+                now = time.time()
+                with db:
+                    # Pages dropped meanwhile (invalidated or expired)
+                    # leave the results uncached.
+                    if db.execute("UPDATE page SET query = ?, created = ? WHERE token = ?",
+                                  (key, now, token)).rowcount == count:
+                        db.execute("DELETE FROM page WHERE store = ? AND kind = ? "
+                                   "AND query = ? AND token != ?",
+                                   (self.store, kind, key, token))
+                        entry = pickle.dumps((token, count), pickle.HIGHEST_PROTOCOL)
+                        db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (self.store, kind, QUERY, key, buffer(entry), size, now, now))
+                        self._evict(db, now)
+                        token = None
+        finally:
+            if token:
+                self._drop_pages(token)
+
+    def _drop_pages(self, token):
+        with self.db:
+            self.db.execute("DELETE FROM page WHERE token = ?", (token,))
@@ -0,0 +1,280 @@
+# Input formats, detected from magic bytes, and their decompression.
+# xz and zstd support need backports.lzma and zstandard.
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from struct import unpack_from
+import bz2
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP, BGZF, BZIP2, XZ, ZSTD, PLAIN = "gzip", "bgzf", "bzip2", "xz", "zstd", "plain"
+
+# Bytes needed to tell formats apart.
+MAGIC_SIZE = 14
+
+# Decompressed blocks queued ahead of the reader.
+QUEUE_DEPTH = 8
+
+# Errors raised by corrupt or truncated input.
+decompress_errors = (IOError, EOFError, zlib.error)
+if lzma is not None:
+    decompress_errors += (lzma.LZMAError,)
+if zstandard is not None:
+    decompress_errors += (zstandard.ZstdError,)
+
+
+def detect_format(head):
+    """
+        Return the format of data starting with `head`.
+    """
+    if head.startswith("\x1f\x8b"):
+        if head[2:4] == "\x08\x04" and head[12:14] == "BC":
+            return BGZF
+        return GZIP
+    elif head.startswith("BZh"):
+        return BZIP2
+    elif head.startswith("\xfd7zXZ\x00"):
+        return XZ
+    elif head.startswith("\x28\xb5\x2f\xfd"):
+        return ZSTD
+    return PLAIN
+
+
+def file_format(filename):
+    with open(filename, 'rb') as f:
+        return detect_format(f.read(MAGIC_SIZE))
+
+
+def missing_module(filename):
+    """
+        Return the module needed to decompress a file that is
+        not installed, or None.
+    """
+    fmt = file_format(filename)
+    if fmt == XZ and lzma is None:
+        return "backports.lzma"
+    elif fmt == ZSTD and zstandard is None:
+        return "zstandard"
+
+
+def _ended(d):
+    # Whether the stream of decompressor `d` has ended. Python 2
+    # zlib and bz2 decompressors have no eof: a finished zlib
+    # stream leaves further input unused, and a finished bzip2
+    # stream refuses it.
+    if hasattr(d, "eof"):
+        return d.eof
+    if isinstance(d, bz2.BZ2Decompressor):
+        try:
+            d.decompress("\0")
+        except EOFError:
+            return True
+        except IOError:
+            pass
+        return False
+    if hasattr(d, "copy"):
+        probe = d.copy()
+        try:
+            probe.decompress("\0")
+        except zlib.error:
+            return False
+        return probe.unused_data == "\0"
+    return True
+
+
+def _stream_blocks(chunks, decompressor, complete=True):
+    # Decompress concatenated streams (gzip members, bzip2, xz or
+    # zstd streams), starting a new decompressor for each one.
+    # Complete input that ends within a stream is truncated.
+    d = decompressor()
+    for raw in chunks:
+        try:
+            block = d.decompress(raw)
+        except EOFError:
+            # The stream ended exactly at the end of the last chunk.
+            d = decompressor()
+            block = d.decompress(raw)
+        while getattr(d, "unused_data", ""):
+            unused = d.unused_data
+            d = decompressor()
+            block += d.decompress(unused)
+        if block:
+            yield block
+    if complete and not _ended(d):
+        raise EOFError("Compressed input ends within a stream")
+    if hasattr(d, "flush"):
+        block = d.flush()
+        if block:
+            yield block
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _bgzf_members(chunks):
+    # Split raw BGZF data into lists of whole blocks (gzip members),
+    # using the block size stored in every block header.
+    data = ""
+    for raw in chunks:
+        data = data + raw
+        members = []
+        pos = 0
+        while len(data) - pos >= 18:
+            if data[pos:pos + 4] != "\x1f\x8b\x08\x04" or \
+               data[pos + 12:pos + 14] != "BC":
+                raise zlib.error("Invalid BGZF block")
+            size = unpack_from("<H", data, pos + 16)[0] + 1
+            if len(data) - pos < size:
+                break
+            members.append(data[pos:pos + size])
+            pos += size
+        data = data[pos:]
+        if members:
+            yield members
+    if data:
+        raise zlib.error("Truncated BGZF block")
+
+
+def _inflate(members):
+    # zlib releases the GIL while inflating.
+    return "".join([zlib.decompress(m, 16 + zlib.MAX_WBITS) for m in members])
+
+
+def _bgzf_blocks(chunks, threads):
+    """
+        Decompress BGZF blocks on a thread pool, keeping the
+        order of the blocks and at most 2 * threads in flight.
+    """
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for members in _bgzf_members(chunks):
+            pending.append(pool.apply_async(_inflate, (members,)))
+            while len(pending) > 2 * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def _put(queue, item, stop):
+    # Put an item unless the reader has stopped.
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _produce(blocks, queue, stop):
+    try:
+        for block in blocks:
+            if not _put(queue, (block, None), stop):
+                return
+        _put(queue, (None, None), stop)
+    except Exception as e:
+        _put(queue, (None, e), stop)
+
+
+def background(blocks, depth=QUEUE_DEPTH):
+    """
+        Run an iterator of blocks on a background thread, feeding
+        a bounded queue, so that producing the next blocks overlaps
+        with consuming this one. Errors are re-raised here.
+    """
+    queue = Queue(depth)
+    stop = threading.Event()
+    thread = threading.Thread(target=_produce, args=(blocks, queue, stop))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            try:
+                # A timeout keeps the wait interruptible.
+                block, error = queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if error is not None:
+                raise error
+            if block is None:
+                break
+            yield block
+    finally:
+        # Stop the producer before its input is used elsewhere.
+        stop.set()
+        thread.join()
+
+
+def decompress_blocks(chunks, threads=None, prefetch=True, complete=True):
+    """
+        Yield decompressed blocks from raw blocks of any supported
+        format, decompressing on a background thread. BGZF blocks
+        are decompressed on `threads` threads.
+
+        With `prefetch` unset, each block is decompressed when it is
+        asked for, from one raw block, so that no raw blocks are read
+        ahead of the blocks yielded (as sampling needs to measure the
+        compression ratio of what it has read).
+
+        Input that ends within a compressed stream raises EOFError,
+        unless `complete` is unset (for stretches of a file).
+    """
+    chunks = iter(chunks)
+    raw = next(chunks, "")
+    fmt = detect_format(raw)
+    if fmt == PLAIN:
+        if raw:
+            yield raw
+        for raw in chunks:
+            yield raw
+        return
+
+    def raw_chunks():
+        yield raw
+        for x in chunks:
+            yield x
+
+    threads = threads or min(cpu_count(), 4)
+    if not prefetch:
+        threads = 1
+    if fmt == BGZF and threads > 1:
+        blocks = _bgzf_blocks(raw_chunks(), threads)
+    elif fmt in (GZIP, BGZF):
+        blocks = _stream_blocks(raw_chunks(), _gzip_decompressor, complete)
+    elif fmt == BZIP2:
+        blocks = _stream_blocks(raw_chunks(), bz2.BZ2Decompressor, complete)
+    elif fmt == XZ:
+        if lzma is None:
+            raise ImportError("xz input requires backports.lzma")
+        blocks = _stream_blocks(raw_chunks(), lzma.LZMADecompressor, complete)
+    elif fmt == ZSTD:
+        if zstandard is None:
+            raise ImportError("zstd input requires zstandard")
+        blocks = _stream_blocks(raw_chunks(), _zstd_decompressor, complete)
+    if prefetch:
+        blocks = background(blocks)
+    for block in blocks:
+        yield block
@@ -0,0 +1,122 @@
+from array import array
+import json
+import sys
+import zlib
+
+from fq.backend import blob
+
+# Column types: integer and float columns are packed as little-endian
+# doubles, text columns as NUL-separated UTF-8.
+INT, FLOAT, TEXT = "i", "f", "s"
+
+
+def _convert(s):
+    for fn in (int, float):
+        try:
+            return fn(s)
+        except ValueError:
+            pass
+    return s
+
+
+def _column_type(values):
+    if all(type(v) in (int, long) for v in values):
+        return INT
+    if all(type(v) in (int, long, float) for v in values):
+        return FLOAT
+    return TEXT
+
+
+def _pack_column(values, col_type):
+    if col_type == TEXT:
+        return u"\0".join([u"" if v is None else unicode(v)
+                           for v in values]).encode("utf-8")
+    packed = array("d", values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tostring()
+
+
+def _unpack_column(data, col_type, nrows):
+    if col_type == TEXT:
+        if nrows == 0:
+            return []
+        return data.decode("utf-8").split(u"\0")
+    values = array("d")
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    if col_type == INT:
+        return map(int, values)
+    return values.tolist()
+
+
+def pack_table(columns, rows):
+    """
+        Pack a FastQC module table into a compressed blob of typed
+        columns. Rows shorter than `columns` are padded with None.
+    """
+    ncol = max([len(columns)] + map(len, rows))
+    columns = list(columns) + ["column_" + str(i)
+                               for i in range(len(columns), ncol)]
+    rows = [list(row) + [None] * (ncol - len(row)) for row in rows]
+    header = {"rows": len(rows), "columns": []}
+    payload = []
+    for name, values in zip(columns, zip(*rows) or [()] * ncol):
+        col_type = _column_type(values)
+        data = _pack_column(values, col_type)
+        header["columns"].append([name, col_type, len(data)])
+        payload.append(data)
+    return blob(zlib.compress(json.dumps(header) + "\n" + "".join(payload)))
+
+
+class fastqc_table:
+    """
+        Lazily decoded FastQC module table. Accepts a packed blob or
+        the tab-separated text stored by earlier versions.
+    """
+
+    def __init__(self, value, columns=()):
+        self.value = value
+        self._columns = list(columns)
+        self._data = None
+
+    def _decode(self):
+        if self._data is not None:
+            return
+        if isinstance(self.value, unicode):
+            # Legacy TSV text.
+            rows = [map(_convert, x.split("\t"))
+                    for x in self.value.splitlines()]
+            ncol = max([len(self._columns)] + map(len, rows))
+            rows = [row + [None] * (ncol - len(row)) for row in rows]
+            self._data = map(list, zip(*rows)) if rows else [[]] * ncol
+            self._columns += ["column_" + str(i)
+                              for i in range(len(self._columns), ncol)]
+            return
+        data = zlib.decompress(self.value)
+        header, data = data.split("\n", 1)
+        header = json.loads(header)
+        self._columns = []
+        self._data = []
+        offset = 0
+        for name, col_type, length in header["columns"]:
+            self._columns.append(name)
+            self._data.append(_unpack_column(data[offset:offset + length],
+                                             col_type,
+                                             header["rows"]))
+            offset += length
+
+    @property
+    def columns(self):
+        self._decode()
+        return self._columns
+
+    def column(self, name):
+        self._decode()
+        return self._data[self._columns.index(name)]
+
+    def rows(self):
+        self._decode()
+        return zip(*self._data)
+
@@ -1,29 +1,19 @@
-from collections import OrderedDict
-from subprocess import Popen, PIPE
-import mimetypes
-import gzip
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
+from math import exp, floor, log, sqrt
+import cPickle as pickle
+import hashlib
+import mmap
+import os
+import random
 import re
-from itertools import groupby as g
-
-legacy_illumina_header = ["instrument",
-                          "flowcell_lane",
-                          "flowcell_number",
-                          None,  # x-tile
-                          None,  # y-tile
-                          "barcode",  # barcode - fetched later
-                          "pair"]
-
-illumina_header = ["instrument",
-                   "run_id",
-                   "flowcell_id",
-                   "flowcell_lane",
-                   None,  # tile number
-                   None,  # x-tile
-                   None,  # y-tile
-                   "pair",
-                   "filtered",
-                   "control_bits",
-                   "barcode"]  # barcode/index sequence; fetched later.
+import time
+from fq.compression import BGZF, PLAIN, decompress_blocks, decompress_errors
+from fq.compression import MAGIC_SIZE, detect_format, file_format
+from fq.headers import header_split, header_stats, illumina_header, legacy_illumina_header
+from fq.qc import qc_stats
+from fq.sketch import duplicate_sketch
 
 pacbio_header = [""]
 
@@ -57,25 +47,927 @@ def autoconvert(s):
     return s
 
 def most_common(L):
-    # Fetch most common item from a list.
-  try:
-    return max(g(sorted(L)), key=lambda(x, v):(len(list(v)),-L.index(x)))[0]
-  except:
-    return ""
+    # Fetch most common item from a list (the first seen on ties).
+    counts = {}
+    for x in L:
+        counts[x] = counts.get(x, 0) + 1
+    best = ""
+    for x in L:
+        if counts[x] > counts.get(best, 0):
+            best = x
+    return best
+
+# Size of raw blocks read from disk.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Default memory budget (bytes) for duplicate estimation.
+SKETCH_MEMORY = 256 * 1024 * 1024
+
+
+# Bytes searched for a record boundary when splitting a file.
+BOUNDARY_WINDOW = 1024 * 1024
+
+# Number of records used to sniff the header format and barcode.
+SNIFF_RECORDS = 1000
+
+# Leaf size for tree hashes.
+TREE_LEAF_SIZE = 16 * 1024 * 1024
+
+# Minimum seconds between progress callbacks.
+PROGRESS_INTERVAL = 0.5
+
+# Default seconds between checkpoints of a profile.
+CHECKPOINT_INTERVAL = 300
+
+# Default number of reads used by --sample.
+SAMPLE_READS = 100000
+
+# Number of evenly spaced offsets read by seek sampling.
+SEEK_POINTS = 16
+
+# Sampled stats that are scaled up to the whole file.
+scaled_stats = ["cum_length",
+                "A_count",
+                "T_count",
+                "C_count",
+                "G_count",
+                "N_count",
+                "bases"]
+
+# Fields recording how a sampled profile was made.
+# Duplication of a sample does not scale with the number of reads,
+# so it is stored as that of the sample (with a sample_ prefix).
+sample_duplicate_stats = ["unique_reads",
+                          "unique_reads_error",
+                          "percent_unique",
+                          "percent_unique_error",
+                          "most_abundant_sequence",
+                          "most_abundant_frequency",
+                          "most_abundant_frequency_error",
+                          "most_abundant_frequency_percent",
+                          "duplicate_method"]
+
+sample_fields = ["sample_method",
+                 "sample_reads",
+                 "sample_fraction",
+                 "total_reads_error"] + ["sample_" + k for k in sample_duplicate_stats]
+
+
+def read_chunks(filename, block_size=BLOCK_SIZE, offset=0, limit=None):
+    """
+        Yield raw blocks of a file, starting at `offset` and
+        stopping after `limit` bytes if given.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for raw in iter(lambda: f.read(block_size), ""):
+            if limit is not None:
+                raw = raw[:limit]
+                limit -= len(raw)
+            if raw:
+                yield raw
+            if limit == 0:
+                break
+
+
+def digest_chunks(chunks, digests, progress=None):
+    """
+        Pass raw blocks through, updating hashlib-like digests. An
+        optional progress callback receives the bytes read so far
+        at most every PROGRESS_INTERVAL seconds.
+    """
+    done = 0
+    last = time.time()
+    for raw in chunks:
+        for digest in digests:
+            digest.update(raw)
+        done += len(raw)
+        if progress and time.time() - last > PROGRESS_INTERVAL:
+            last = time.time()
+            progress(done)
+        yield raw
+    if progress:
+        progress(done)
+
+
+def _md5_digest(data):
+    return hashlib.md5(data).digest()
+
+
+class tree_hash:
+    """
+        Hashlib-like fingerprint over fixed-size leaves. Leaves are
+        hashed with md5 on a thread pool (hashlib releases the GIL)
+        and their digests are hashed again to give the root.
+    """
+    name = "tree_md5"
+
+    def __init__(self, threads=None, leaf_size=TREE_LEAF_SIZE):
+        self.threads = threads or min(cpu_count(), 8)
+        self.leaf_size = leaf_size
+        self.pool = ThreadPool(self.threads)
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.root = hashlib.md5()
+
+    def _submit(self, leaf):
+        self.pending.append(self.pool.apply_async(_md5_digest, (leaf,)))
+        # Bound the number of leaves held in memory.
+        while len(self.pending) > 2 * self.threads:
+            self.root.update(self.pending.popleft().get())
+
+    def update(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.leaf_size:
+            data = "".join(self.buffer)
+            for i in xrange(0, len(data) - self.leaf_size + 1, self.leaf_size):
+                self._submit(data[i:i + self.leaf_size])
+            remainder = data[i + self.leaf_size:]
+            self.buffer = [remainder]
+            self.buffered = len(remainder)
+
+    def hexdigest(self):
+        if self.buffered or not self.pending:
+            self._submit("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self.root.update(self.pending.popleft().get())
+        self.pool.close()
+        return self.root.hexdigest()
+
+
+def iter_blocks(filename, block_size=BLOCK_SIZE):
+    """
+        Yield decompressed blocks of a (optionally compressed) file.
+    """
+    return decompress_blocks(read_chunks(filename, block_size))
+
+
+def read_record_blocks(blocks, final=True):
+    """
+        Split decompressed blocks into fastq records and yield
+        the lines of every complete record in a block. A last
+        record without a trailing newline is kept if `final`.
+    """
+    tail = ""
+    for block in blocks:
+        if "\r" in block:
+            block = block.replace("\r", "")
+        lines = (tail + block).split("\n")
+        # Carry incomplete records over to the next block.
+        n = (len(lines) - 1) // 4 * 4
+        tail = "\n".join(lines[n:])
+        del lines[n:]
+        yield lines
+    lines = tail.split("\n")
+    if final and len(lines) >= 4:
+        yield lines[:4]
+
+
+def map_file(filename):
+    """
+        Memory-map a file read-only, or return None if it is
+        empty or compressed.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(MAGIC_SIZE)
+        if not head or detect_format(head) != PLAIN:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def mapped_record_blocks(mapped, start=0, end=None, block_size=BLOCK_SIZE):
+    """
+        Like read_record_blocks for the records of a mapped file
+        between two record boundaries. Blocks are sliced from the
+        map and cut after their last complete record, so nothing
+        is carried over and rejoined between blocks.
+    """
+    if end is None:
+        end = len(mapped)
+    pos = start
+    while pos < end:
+        block = mapped[pos:min(pos + block_size, end)]
+        lines = block.split("\n")
+        if pos + len(block) == end:
+            if not lines[-1]:
+                lines.pop()
+            n = len(lines) // 4 * 4
+            pos = end
+        else:
+            n = (len(lines) - 1) // 4 * 4
+            if n == 0:
+                # A record longer than the block.
+                block_size *= 2
+                continue
+            # Bytes after the last complete record.
+            rest = lines[n:]
+            pos += len(block) - sum(map(len, rest)) - len(rest) + 1
+        del lines[n:]
+        if "\r" in block:
+            lines = [line.replace("\r", "") for line in lines]
+        if lines:
+            yield lines
+
+
+def record_ranges(mapped, parts):
+    """
+        Split a mapped fastq into at most `parts` (start, end)
+        byte ranges that each begin at a record boundary.
+    """
+    size = len(mapped)
+    starts = [0]
+    for k in range(1, parts):
+        offset = max(size * k // parts, starts[-1] + 1)
+        window = BOUNDARY_WINDOW
+        while True:
+            # Include the preceding newline of a record at offset.
+            i = _record_start(mapped[offset - 1:offset + window])
+            if i != -1 or offset + window >= size:
+                break
+            window *= 2
+        if i == -1:
+            break
+        starts.append(offset - 1 + i)
+    return zip(starts, starts[1:] + [size])
+
+
+def record_blocks(filename):
+    """
+        Yield the lines of complete records of a file, read
+        through a memory map if it is uncompressed.
+    """
+    mapped = map_file(filename)
+    if mapped is None:
+        return read_record_blocks(iter_blocks(filename))
+    return mapped_record_blocks(mapped)
+
+
+class checkpoint:
+    """
+        Periodically saved profiling state of one file: the stats
+        accumulator and the number of records it has counted.
+
+        Decompressor and digest state cannot be saved, so a resumed
+        profile reads the file from the start but skips the stats
+        of records counted before the checkpoint.
+    """
+
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.last = time.time()
+
+    def resume(self, stats):
+        """
+            Return the saved stats and record count if they were
+            made with the same settings as `stats`, else (stats, 0).
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                saved, records = pickle.load(f)
+        except Exception:
+            return stats, 0
+        # Checkpoints of other settings or versions are ignored.
+        if saved.settings() != stats.settings() or \
+           sorted(vars(saved)) != sorted(vars(stats)) or \
+           (stats.qc is not None and sorted(vars(saved.qc)) != sorted(vars(stats.qc))):
+            return stats, 0
+        return saved, records
+
+    def update(self, stats, records):
+        if time.time() - self.last < self.interval:
+            return
+        # Replace the previous checkpoint atomically.
+        with open(self.path + ".tmp", 'wb') as f:
+            pickle.dump((stats, records), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(self.path + ".tmp", self.path)
+        self.last = time.time()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _profile_block(stats, lines, skip):
+    # Update stats with a block, first dropping `skip` records
+    # counted previously. Returns the number left to skip.
+    if skip:
+        n = min(skip, len(lines) // 4)
+        skip -= n
+        del lines[:4 * n]
+    stats.update(lines[1::4], lines[3::4], lines[0::4])
+    return skip
+
+
+class record_batch:
+    """
+        The complete records of one decompressed block. The block
+        is split into lines once (in C); headers, sequences and
+        qualities are strided slices of those lines, so consumers
+        work a batch at a time rather than a record at a time.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.lines) // 4
+
+    @property
+    def headers(self):
+        return self.lines[0::4]
+
+    @property
+    def seqs(self):
+        return self.lines[1::4]
+
+    @property
+    def quals(self):
+        return self.lines[3::4]
+
+    def __iter__(self):
+        # (header, seq, qual) of each record.
+        lines = self.lines
+        for i in xrange(0, len(lines) - 3, 4):
+            yield lines[i], lines[i + 1], lines[i + 3]
+
+
+def read_batches(filename):
+    """
+        Yield record_batches of a (optionally compressed) file.
+    """
+    for lines in record_blocks(filename):
+        yield record_batch(lines)
+
+
+def _range_stats(task):
+    # Stats of one record-aligned range, in a worker process.
+    filename, start, end, exact, sketch_memory, qc = task
+    stats = fastq_stats(exact, sketch_memory, qc)
+    for lines in mapped_record_blocks(map_file(filename), start, end):
+        stats.update(lines[1::4], lines[3::4], lines[0::4])
+    return stats
+
+
+def map_parts(filename, parts):
+    """
+        Return a memory map of the file if it should be profiled
+        in parts: it is uncompressed, more than one part is asked
+        for and this is not already a worker process.
+    """
+    if parts > 1 and not current_process().daemon:
+        return map_file(filename)
+
+
+def profile_ranges(filename, mapped, parts, exact=False,
+                   sketch_memory=SKETCH_MEMORY, qc=False, chunks=()):
+    """
+        Profile record-aligned ranges of a mapped file in `parts`
+        processes, each within an equal share of `sketch_memory`.
+        `chunks` are consumed (e.g. hashed) meanwhile.
+    """
+    ranges = record_ranges(mapped, parts)
+    tasks = [(filename, start, end, exact, sketch_memory // len(ranges), qc)
+             for start, end in ranges]
+    pool = Pool(len(tasks))
+    try:
+        results = pool.map_async(_range_stats, tasks)
+        pool.close()
+        for raw in chunks:
+            pass
+        stats = fastq_stats(exact, sketch_memory, qc)
+        for part in results.get():
+            stats.merge(part)
+    finally:
+        pool.terminate()
+    return stats
+
+
+def scan_fastq(filename, exact=False, sketch_memory=SKETCH_MEMORY,
+               digests=(), progress=None, qc=False, checkpoint=None, parts=1):
+    """
+        Read a file once: raw blocks update `digests` while the
+        decompressed records are sniffed and summarised.
+
+        Returns a fastq_reader and its stats. Stats are only
+        calculated if the file looks like a fastq. An optional
+        checkpoint is resumed from and saved to as records are read.
+        Uncompressed files are profiled in `parts` processes while
+        they are hashed, without checkpoints.
+    """
+    chunks = read_chunks(filename)
+    if digests:
+        chunks = digest_chunks(chunks, digests, progress)
+    mapped = map_parts(filename, parts)
+    if mapped is not None:
+        fq = fastq_reader(filename)
+        if fq.error:
+            stats = None
+        else:
+            stats = profile_ranges(filename, mapped, parts, exact,
+                                   sketch_memory, qc, chunks)
+        for raw in chunks:
+            pass
+        if stats is None or stats.total_reads == 0:
+            return fq, {'error': ['error while calculating fastq stats']}
+        return fq, stats.result()
+    stats = fastq_stats(exact, sketch_memory, qc)
+    records = 0
+    if checkpoint:
+        stats, records = checkpoint.resume(stats)
+    skip = records
+    fq = None
+    try:
+        for lines in read_record_blocks(decompress_blocks(chunks)):
+            if fq is None:
+                fq = fastq_reader(filename, lines[0:4 * SNIFF_RECORDS:4])
+                if fq.error:
+                    break
+            skip = _profile_block(stats, lines, skip)
+            records += len(lines) // 4
+            if checkpoint and not skip:
+                checkpoint.update(stats, records)
+    except decompress_errors:
+        stats = None
+    # Finish hashing anything left unread.
+    for raw in chunks:
+        pass
+    if fq is None:
+        fq = fastq_reader(filename, [])
+    if stats is None or stats.total_reads == 0:
+        return fq, {'error': ['error while calculating fastq stats']}
+    if checkpoint:
+        checkpoint.clear()
+    return fq, stats.result()
+
+
+def is_bgzf(filename):
+    """
+        Test for BGZF: gzip made of independent blocks that
+        can be decompressed starting from any block.
+    """
+    return file_format(filename) == BGZF
+
+
+def _bgzf_start(chunks):
+    # Drop raw bytes before the first BGZF block header.
+    chunks = iter(chunks)
+    data = ""
+    for raw in chunks:
+        data += raw
+        i = data.find("\x1f\x8b\x08\x04")
+        while i != -1 and len(data) >= i + 14 and data[i + 12:i + 14] != "BC":
+            i = data.find("\x1f\x8b\x08\x04", i + 1)
+        if i == -1:
+            data = data[-3:]
+        elif len(data) < i + 14:
+            data = data[i:]
+        else:
+            yield data[i:]
+            break
+    for raw in chunks:
+        yield raw
+
+
+def _record_start(block):
+    # Offset of the first complete record in a block, or -1.
+    i = block.find("\n@")
+    while i != -1:
+        ends = [i]
+        for line in range(4):
+            ends.append(block.find("\n", ends[-1] + 1))
+            if ends[-1] == -1:
+                return -1
+        seq, plus, qual = [block[ends[x] + 1:ends[x + 1]].rstrip("\r")
+                           for x in (1, 2, 3)]
+        if plus.startswith("+") and len(seq) == len(qual):
+            return i + 1
+        i = block.find("\n@", i + 1)
+    return -1
+
+
+def _aligned_blocks(blocks):
+    # Skip ahead to the first record boundary.
+    blocks = iter(blocks)
+    data = ""
+    for block in blocks:
+        data += block
+        i = _record_start(data)
+        if i != -1:
+            yield data[i:]
+            break
+    for block in blocks:
+        yield block
+
+
+def _count(blocks, sizes, key):
+    for block in blocks:
+        sizes[key] += len(block)
+        yield block
+
+
+def _take(record_blocks, n):
+    # Yield the first n records.
+    for lines in record_blocks:
+        lines = lines[:4 * n]
+        n -= len(lines) // 4
+        yield lines
+        if n <= 0:
+            return
+
+
+def _head_records(filename, n, sizes):
+    # Without prefetch, raw and decompressed sizes cover the same data.
+    chunks = _count(read_chunks(filename), sizes, "raw")
+    blocks = _count(decompress_blocks(chunks, prefetch=False), sizes, "decompressed")
+    return _take(read_record_blocks(blocks), n)
+
+
+def _seek_records(filename, n, sizes, bgzf):
+    spacing = os.path.getsize(filename) // SEEK_POINTS
+    per_point = -(-n // SEEK_POINTS)
+    for point in range(SEEK_POINTS):
+        # Reads from one offset stop at the next.
+        chunks = read_chunks(filename, BLOCK_SIZE // 4,
+                             offset=point * spacing,
+                             limit=spacing or None)
+        if bgzf and point:
+            chunks = _bgzf_start(chunks)
+        chunks = _count(chunks, sizes, "raw")
+        # Stretches end mid-block, so BGZF is inflated as a stream.
+        blocks = _count(decompress_blocks(chunks, prefetch=False, complete=False),
+                        sizes, "decompressed")
+        if point:
+            blocks = _aligned_blocks(blocks)
+        for lines in _take(read_record_blocks(blocks, final=False), per_point):
+            yield lines
+        if not spacing:
+            break
+
+
+def _uniform():
+    # Uniform on the open interval (0, 1).
+    u = 0.0
+    while u == 0.0:
+        u = random.random()
+    return u
+
+
+def _reservoir_records(filename, n, sizes):
+    """
+        Draw a uniform sample of n records in one pass (Algorithm L,
+        which skips ahead between replacements). The number of
+        records read is stored in sizes["records"].
+    """
+    sample = []
+    seen = 0
+    w = exp(log(_uniform()) / n)
+    next_index = n + int(floor(log(_uniform()) / log(1 - w)))
+    for lines in record_blocks(filename):
+        count = len(lines) // 4
+        fill = min(count, n - len(sample))
+        for k in xrange(fill):
+            sample.append(lines[4 * k:4 * k + 4])
+        while next_index < seen + count:
+            k = next_index - seen
+            sample[random.randrange(n)] = lines[4 * k:4 * k + 4]
+            w *= exp(log(_uniform()) / n)
+            next_index += int(floor(log(_uniform()) / log(1 - w))) + 1
+        seen += count
+    sizes["records"] = seen
+    for k in xrange(0, len(sample), SNIFF_RECORDS):
+        yield [line for record in sample[k:k + SNIFF_RECORDS] for line in record]
+
+
+def sample_fastq(filename, method="seek", n=SAMPLE_READS, exact=False,
+                 sketch_memory=SKETCH_MEMORY, qc=False):
+    """
+        Profile a sample of about n reads and scale the stats
+        up to the whole file. Duplication is that of the sample.
+
+        head reads the first n reads. reservoir reads every read
+        but only profiles a uniform sample of them. seek reads
+        evenly spaced stretches of plain or BGZF files; other
+        compressed files fall back to head.
+
+        total_reads is estimated from the mean record size and the
+        compression ratio of the sample, with a 95% confidence half
+        width in total_reads_error. Read counts in the lane/tile,
+        barcode and QC tables are scaled by the same factor.
+    """
+    filesize = os.path.getsize(filename)
+    if method == "seek":
+        fmt = file_format(filename)
+        bgzf = fmt == BGZF
+        if fmt not in (BGZF, PLAIN):
+            method = "head"
+    sizes = {"raw": 0, "decompressed": 0}
+    if method == "head":
+        records = _head_records(filename, n, sizes)
+    elif method == "seek":
+        records = _seek_records(filename, n, sizes, bgzf)
+    elif method == "reservoir":
+        records = _reservoir_records(filename, n, sizes)
+    else:
+        raise ValueError("Unknown sample method: " + method)
+    stats = fastq_stats(exact, sketch_memory, qc)
+    record_bytes = 0
+    record_bytes_sq = 0
+    try:
+        for lines in records:
+            stats.update(lines[1::4], lines[3::4], lines[0::4])
+            if method != "reservoir":
+                for k in xrange(0, len(lines), 4):
+                    size = sum(map(len, lines[k:k + 4])) + 4
+                    record_bytes += size
+                    record_bytes_sq += size * size
+    except decompress_errors:
+        return {'error': ['error while calculating fastq stats']}
+    sampled = stats.total_reads
+    if sampled == 0:
+        return {'error': ['error while calculating fastq stats']}
+    if method == "reservoir":
+        total, error = sizes["records"], 0.0
+    elif method == "head" and sampled < n:
+        # The whole file was read.
+        total, error = sampled, 0.0
+    else:
+        mean = record_bytes / float(sampled)
+        sd = sqrt(max(record_bytes_sq / float(sampled) - mean * mean, 0))
+        total = filesize * sizes["decompressed"] / float(sizes["raw"]) / mean
+        error = 1.96 * total * sd / mean / sqrt(sampled)
+    scale = total / float(sampled)
+    stats.headers.scale(scale)
+    if stats.qc:
+        stats.qc.scale(scale)
+    d = stats.result()
+    for k in scaled_stats:
+        if k in d:
+            if isinstance(d[k], float):
+                d[k] *= scale
+            else:
+                d[k] = int(round(d[k] * scale))
+    for k in sample_duplicate_stats:
+        if k in d:
+            d["sample_" + k] = d.pop(k)
+    d["total_reads"] = int(round(total))
+    d["sample_method"] = method
+    d["sample_reads"] = sampled
+    d["sample_fraction"] = sampled / float(max(total, sampled))
+    d["total_reads_error"] = error
+    return d
+
+
+class fastq_stats:
+    # Streaming accumulator for sequence statistics.
+    def __init__(self, exact=False, sketch_memory=SKETCH_MEMORY, qc=False):
+        self.sketch_memory = sketch_memory
+        self.total_reads = 0
+        self.cum_length = 0
+        self.min_length = None
+        self.max_length = None
+        self.base_counts = dict.fromkeys("ATCGN", 0)
+        # Exact per-sequence counts, or a bounded-memory sketch.
+        self.exact = exact
+        if exact:
+            self.counts = {}
+        else:
+            self.sketch = duplicate_sketch(sketch_memory)
+        # FastQC-equivalent module tables.
+        self.qc = qc_stats() if qc else None
+        # Barcode and lane/tile counts.
+        self.headers = header_stats()
+
+    def update(self, seqs, quals=None, headers=None):
+        if not seqs:
+            return
+        if headers:
+            self.headers.update(headers)
+        if self.qc:
+            self.qc.update(seqs, quals)
+        joined = "".join(seqs)
+        for base in self.base_counts:
+            self.base_counts[base] += joined.count(base)
+        lengths = map(len, seqs)
+        min_length, max_length = min(lengths), max(lengths)
+        if self.min_length is None or min_length < self.min_length:
+            self.min_length = min_length
+        if max_length > self.max_length:
+            self.max_length = max_length
+        self.total_reads += len(seqs)
+        self.cum_length += len(joined)
+        if self.exact:
+            counts = self.counts
+        else:
+            counts = {}
+        get = counts.get
+        for seq in seqs:
+            counts[seq] = get(seq, 0) + 1
+        if not self.exact:
+            self.sketch.update(counts)
+
+    def settings(self):
+        return self.exact, self.sketch_memory, self.qc is not None
+
+    def merge(self, other):
+        """
+            Add the stats of another part of the same file, so
+            that parts can be profiled independently.
+        """
+        self.total_reads += other.total_reads
+        self.cum_length += other.cum_length
+        for base, n in other.base_counts.iteritems():
+            self.base_counts[base] += n
+        if other.min_length is not None:
+            self.min_length = min(self.min_length, other.min_length) \
+                if self.min_length is not None else other.min_length
+        self.max_length = max(self.max_length, other.max_length)
+        if self.exact:
+            get = self.counts.get
+            for seq, n in other.counts.iteritems():
+                self.counts[seq] = get(seq, 0) + n
+        else:
+            self.sketch.merge(other.sketch)
+        if self.qc:
+            self.qc.merge(other.qc)
+        self.headers.merge(other.headers)
+
+    def result(self):
+        total = self.total_reads
+        if self.exact:
+            unique = sum(1 for v in self.counts.itervalues() if v == 1)
+            max_read, max_count = max(self.counts.iteritems(),
+                                      key=lambda x: x[1])
+        else:
+            unique, unique_error = self.sketch.sample.estimate(singletons=True)
+            max_read, max_count = self.sketch.hitters.most_common()
+        d = OrderedDict(zip(stat_header,
+                            [total,
+                             unique,
+                             unique * 100.0 / total,
+                             max_read,
+                             max_count,
+                             max_count * 100.0 / total]))
+        if self.exact:
+            d["duplicate_method"] = "exact"
+        else:
+            d["duplicate_method"] = "sketch"
+            d["unique_reads_error"] = unique_error
+            d["percent_unique_error"] = unique_error * 100.0 / total
+            d["most_abundant_frequency_error"] = self.sketch.hitters.error
+        A, T, C, G, N = [self.base_counts[x] for x in "ATCGN"]
+        d["cum_length"] = self.cum_length
+        d["A_count"] = A
+        d["T_count"] = T
+        d["C_count"] = C
+        d["G_count"] = G
+        d["N_count"] = N
+        d["bases"] = A + T + C + G
+        d["GC_content"] = (G + C) / float(self.cum_length)
+        d["min_length"] = self.min_length
+        d["avg_length"] = self.cum_length / float(total)
+        d["max_length"] = self.max_length
+        if self.qc:
+            d.update(self.qc.result())
+        d.update(self.headers.result())
+        return d
+
+
+def _read_names(headers):
+    # Read names without comments or /1 and /2 suffixes.
+    names = [h.split(None, 1)[0] if h else h for h in headers]
+    return [n[:-2] if n[-2:] in ("/1", "/2") else n for n in names]
+
+
+class pair_stats:
+    """
+        Streaming accumulator for mates read in lockstep: checks
+        that read names stay in sync and counts duplicate pairs.
+    """
+
+    def __init__(self, exact=False, sketch_memory=SKETCH_MEMORY):
+        self.pairs = 0
+        self.concordant = 0
+        self.first_discordant = None
+        self.unpaired = 0
+        # Duplicates are counted over joined mate sequences.
+        self.duplicates = fastq_stats(exact, sketch_memory)
+
+    def update(self, lines1, lines2):
+        matches = map(str.__eq__, _read_names(lines1[0::4]),
+                      _read_names(lines2[0::4]))
+        concordant = sum(matches)
+        if concordant < len(matches) and self.first_discordant is None:
+            self.first_discordant = self.pairs + 1 + matches.index(False)
+        self.concordant += concordant
+        self.pairs += len(matches)
+        self.duplicates.update([a + b for a, b in zip(lines1[1::4], lines2[1::4])])
+
+    def result(self):
+        d = OrderedDict()
+        d["pair_reads"] = self.pairs
+        d["pair_concordant_reads"] = self.concordant
+        d["pair_unpaired_reads"] = self.unpaired
+        if self.first_discordant is not None:
+            d["pair_first_discordant_read"] = self.first_discordant
+        if self.pairs:
+            duplicates = self.duplicates.result()
+            d["pair_unique_reads"] = duplicates["unique_reads"]
+            d["pair_percent_unique"] = duplicates["percent_unique"]
+        return d
+
+
+def scan_pair(filenames, exact=False, sketch_memory=SKETCH_MEMORY,
+              digests=((), ()), qc=False):
+    """
+        Read two mate files in lockstep, like scan_fastq for each
+        file, while comparing the mates record by record.
+
+        Returns a fastq_reader and stats for each file and the
+        pair stats. Stats are None for files that could not be read.
+        Duplicates are estimated for each file and for the pair
+        within a third of `sketch_memory` each.
+    """
+    record_blocks = []
+    chunks = []
+    for filename, file_digests in zip(filenames, digests):
+        file_chunks = digest_chunks(read_chunks(filename), file_digests)
+        chunks.append(file_chunks)
+        record_blocks.append(read_record_blocks(decompress_blocks(file_chunks)))
+    fqs = [None, None]
+    # Both mates and the pair share the memory budget.
+    sketch_memory //= 3
+    stats = [fastq_stats(exact, sketch_memory, qc) for filename in filenames]
+    pair = pair_stats(exact, sketch_memory)
+    buffers = [[], []]
+    done = [False, False]
+    try:
+        while True:
+            for i in (0, 1):
+                while not buffers[i] and not done[i]:
+                    lines = next(record_blocks[i], None)
+                    if lines is None:
+                        done[i] = True
+                        continue
+                    if fqs[i] is None:
+                        fqs[i] = fastq_reader(filenames[i],
+                                              lines[0:4 * SNIFF_RECORDS:4])
+                        if fqs[i].error:
+                            done[i] = True
+                            continue
+                    buffers[i] = lines
+            n = min(len(buffers[0]), len(buffers[1])) // 4
+            if n == 0:
+                if not buffers[0] and not buffers[1]:
+                    break
+                # One file has ended; the other's records are unpaired.
+                for i in (0, 1):
+                    stats[i].update(buffers[i][1::4], buffers[i][3::4], buffers[i][0::4])
+                    pair.unpaired += len(buffers[i]) // 4
+                    buffers[i] = []
+                continue
+            paired = [buffers[0][:4 * n], buffers[1][:4 * n]]
+            for i in (0, 1):
+                del buffers[i][:4 * n]
+                stats[i].update(paired[i][1::4], paired[i][3::4], paired[i][0::4])
+            pair.update(*paired)
+    except decompress_errors:
+        stats = [None, None]
+    # Finish hashing anything left unread.
+    for file_chunks in chunks:
+        for raw in file_chunks:
+            pass
+    results = []
+    for filename, fq, file_stats in zip(filenames, fqs, stats):
+        if fq is None:
+            fq = fastq_reader(filename, [])
+        if file_stats is None or file_stats.total_reads == 0:
+            results.append((fq, {'error': ['error while calculating fastq stats']}))
+        else:
+            results.append((fq, file_stats.result()))
+    return results, pair.result()
+
 
 class fastq_reader:
     # Simple class for reading fastq files.
-    def __init__(self, filename):
+    def __init__(self, filename, header_lines=None):
         self.filename = filename
         # Get fastq information
         try:
-            header_lines = [x["info"] for x in self.read(1)]
+            if header_lines is None:
+                header_lines = next(self.batches()).headers[:SNIFF_RECORDS]
             header_line = header_lines[0]
+            if not header_line.startswith("@"):
+                raise ValueError("Not a fastq header")
+            header = header_split.split(header_line)[::2]
+            self.sequencing = None
             if header_line.count(":") > 3:
-                header = re.split(r'(\:|#|/| )',header_lines[0])[::2]
                 self.sequencing = "Illumina"
             elif re.match(r'^@.*\/[0-9]+\/[0-9]+_[0-9]+', header_line):
-                header = re.split(r'(\:|#|/| )',header_lines[0])[::2]
                 self.sequencing = "PacBio"
             fetch_barcode = True
 
@@ -105,7 +997,7 @@ class fastq_reader:
             if fetch_barcode == True:
                 # Fetch index
                 index_loc = use_header.index("barcode")
-                fetch_index = [re.split(r'(\:|#|/| )',x["info"])[::2][index_loc] for x in self.read(1000)]
+                fetch_index = [header_split.split(x)[::2][index_loc] for x in header_lines]
                 self.barcode = most_common(fetch_index)
 
 
@@ -121,91 +1013,59 @@ class fastq_reader:
             self.error = True
 
 
+    def batches(self):
+        """
+            Yield record_batches of the (optionally compressed) file.
+        """
+        return read_batches(self.filename)
+
     def read(self, n=-1):
         """
-            Iterate through gzipped fastq file and put
-            yield sequence+info in dictionary.
+            Iterate through a fastq file, yielding a new dictionary
+            of info, seq and qual for each record (up to n records).
         """
-        if self.filename.endswith(".gz"):
-            open_file = gzip.open(self.filename, 'rb')
-        else:
-            open_file = open(self.filename, 'r') 
-        with open_file as f:
-            dna = {}
-            for linenum, line in enumerate(f):
-                dna["info"] = line.strip()
-                dna["seq"] = f.next().strip()
-                f.next()
-                dna["qual"] = f.next().strip()
-                if linenum < n or n == -1:
-                    yield dna
-                else:
-                    break
+        for batch in self.batches():
+            for info, seq, qual in batch:
+                if n == 0:
+                    return
+                n -= 1
+                yield {"info": info, "seq": seq, "qual": qual}
 
-    def calculate_fastq_stats(self):
-        if mimetypes.guess_type(self.filename)[1] is None:
-            # Read if not zipped.
-            awk_read = "cat"
-        else:
-            awk_read = "gunzip -c"
-        awk_one_liner =  """ awk '((NR-2)%4==0){ 
-                                read=$1;total++;count[read]++;
-                                print $0;
-                             }
-                             END{
-                             for(read in count){
-                             if(!max||count[read]>max) {
-                                 max=count[read];
-                                 maxRead=read};
-                                 if(count[read]==1){
-                                    unique++
-                                 }
-                             };
-                             print "#AWK",
-                                   total,
-                                   unique,
-                                   unique*100/total,
-                                   maxRead,
-                                   count[maxRead],
-                                   count[maxRead]*100/total}'"""
-        awk = awk_read + " " + self.filename + " | " + awk_one_liner
-        out = Popen([awk], shell = True, stdout = PIPE, stderr = PIPE)
-        min_length = ""
-        max_length = None
-        cum_length = 0
-        A, T, C, G, N = [0]*5
-        d = None # If errored do not return
-        for n, line in enumerate(out.stdout):
-            if line.startswith("#AWK"):
-                d = OrderedDict(zip(stat_header, line.strip().split(" ")[1:]))
-            else:
-                line = line.strip()
-                length = len(line)
-                cum_length += length
-                A += line.count("A")
-                T += line.count("T")
-                C += line.count("C")
-                G += line.count("G")
-                N += line.count("N")
-                if length < min_length:
-                    min_length = length
-                if length > max_length:
-                    max_length = length
-        if d:  
-            d["cum_length"] = cum_length  # Stat line at end + 1
-            d["A_count"] = A
-            d["T_count"] = T
-            d["C_count"] = C
-            d["G_count"] = G
-            d["N_count"] = N
-            d["total_reads"] = int(d["total_reads"])
-            d["unique_reads"] = int(d["unique_reads"])
-            d["bases"] = A + T + C + G
-            d["GC_content"] = (G + C) / float(cum_length)
-            d["min_length"] = min_length
-            d["avg_length"] = cum_length / float(d["total_reads"])
-            d["max_length"] = max_length
-            return d
-        else:
-            return {'error': ['error while parsing with awk']}
+    def calculate_fastq_stats(self, exact=False, sketch_memory=SKETCH_MEMORY,
+                              qc=False, checkpoint=None, parts=1):
+        """
+            Calculate read, length and base composition statistics
+            in a single pass over decompressed blocks of the file.
 
+            Duplicates are estimated within `sketch_memory` bytes
+            unless `exact` counting is requested. FastQC-equivalent
+            module tables are added if `qc` is set. An optional
+            checkpoint is resumed from and saved to as records are read.
+            Uncompressed files are profiled in `parts` processes,
+            without checkpoints.
+        """
+        mapped = map_parts(self.filename, parts)
+        if mapped is not None:
+            stats = profile_ranges(self.filename, mapped, parts, exact,
+                                   sketch_memory, qc)
+            if stats.total_reads == 0:
+                return {'error': ['error while calculating fastq stats']}
+            return stats.result()
+        stats = fastq_stats(exact, sketch_memory, qc)
+        records = 0
+        if checkpoint:
+            stats, records = checkpoint.resume(stats)
+        skip = records
+        try:
+            for lines in record_blocks(self.filename):
+                skip = _profile_block(stats, lines, skip)
+                records += len(lines) // 4
+                if checkpoint and not skip:
+                    checkpoint.update(stats, records)
+        except decompress_errors:
+            return {'error': ['error while calculating fastq stats']}
+        if stats.total_reads == 0:
+            return {'error': ['error while calculating fastq stats']}
+        if checkpoint:
+            checkpoint.clear()
+        return stats.result()
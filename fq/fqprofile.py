@@ -2,44 +2,68 @@
 """
 usage:
     fq profile [options] <fq>...
-    fq fetch <fq>...
-    fq fastqc-dump <fastqc-group> [<fq>...]
-    fq dump
-    fq summary
-    fq query <query>
-    fq set <project> <kind>
+    fq scan [options] <dir>...
+    fq fetch [options] <fq>...
+    fq fastqc-dump [options] <fastqc-group> [<fq>...]
+    fq dump [options]
+    fq summary [options]
+    fq query [options] <query>
+    fq set [options] <project> <kind>
 
 options:
   -h --help                   Show this screen.
   --version                   Show version.
   --verbose                   Speak up
   --fastqc                    Gather fastqc statistics as well
-  --fastqc-threads=<threads>  Additional threads to use for fastqc
+  --fastqc-threads=<threads>  Number of FastQC jobs to run at once [default: 1]
+  --qc                        Calculate FastQC-equivalent tables while profiling
+  --sample=<method>           Profile a sample of reads: head, reservoir or seek
+  --sample-reads=<N>          Number of reads to sample [default: 100000]
+  --paired                    Profile R1/R2 mates together, checking they are in sync
+  --checkpoint=<seconds>      Save progress of a profile this often; 0 disables [default: 300]
   --kv=<k:v>                  Additional key-value pairs to add
+  --exact-duplicates          Count duplicate reads exactly (high memory)
+  --sketch-memory=<MB>        Memory budget for duplicate estimation [default: 256]
+  --jobs=<N>                  Number of fastqs to profile in parallel [default: 1]
+  --split=<N>                 Profile each uncompressed fastq in N parts at once [default: 1]
+  --stat-threads=<N>          Directories listed at once by scan [default: 16]
+  --cache-ttl=<seconds>       Reuse fetched entities and query results this long; 0 disables [default: 3600]
+  --cache-size=<MB>           Size limit of the local cache [default: 256]
+  --tree-hash                 Store a multi-threaded tree hash (tree_md5) as well
+  --batch-size=<N>            Datastore entities per request [default: 100]
+  --backend=<backend>         Storage backend: datastore or sqlite [default: datastore]
+  --db=<db>                   SQLite database used by the sqlite backend
+  --by=<property>             Break summary down by instrument, run_id or flowcell_id
+  --rebuild                   Recalculate summary totals from every fastq
+  --format=<format>           Output format: json, ndjson or tsv [default: json]
+  --fields=<fields>           Comma-separated properties to output
+  --timings=<file>            Write per-phase timings of each fastq as JSON lines
+  --store-timings             Store timings on fastq entities (profile_timings)
+  --cprofile=<file>           Save cProfile stats of the run to a file
 
 """
 
 from docopt import docopt
-from gcloud import datastore
+from fq.backend import lazy_backend
+from fq.cache import cache_miss
 import hashlib
-import io
 import os
 from clint.textui import colored, puts_err, progress, indent
 import fqprofile
 from fq import autoconvert, json_serial, parse_fastqc
 from fq import check_program_exists, fastqc_groups, fastqc_headers
-from fq.fq_util import fastq_reader
+from fq.timings import datastore_calls, phase_timings, cpu_time, peak_rss_mb
 import json
 import os.path
 import sys
 from datetime import datetime
+from itertools import islice
 from math import log
 import re
+import resource
+import signal
 import time
 import glob
-from subprocess import Popen, PIPE
-import tempfile
-import shutil
 from fq import __version__
 import sys
 reload(sys)
@@ -47,36 +71,174 @@ sys.setdefaultencoding('utf-8')
 
 
 def fastqc(filename):
+    """
+        Run FastQC and parse fastqc_data.txt straight from
+        the report zip. The output directory is always removed.
+    """
+    from subprocess import Popen, PIPE
+    import shutil
+    import tempfile
+    import zipfile
     basename = os.path.basename(filename)
     t_dir = tempfile.mkdtemp(prefix=basename)
-    fastqc_results = basename.replace(".fq", "_fastqc") \
-                             .replace(".fastq", "_fastqc") \
-                             .replace("_fastqc.gz", "")
-
-    comm = ["fastqc", "--out", t_dir, "--extract", filename]
-    if threads:
-        comm.insert(1,"--threads")
-        comm.insert(2,threads)
-    out, err = Popen(comm, stdout=PIPE, stderr=PIPE).communicate()
-    # Get folder within tempdir
-    if 'Exception' in err:
-        return {"fastqc_error": err, "error" : ["fastqc_error"]}
-    fqc_file = glob.glob(os.path.join(t_dir, "*", "fastqc_data.txt"))[0]
-    results = parse_fastqc(fqc_file)
-    shutil.rmtree(t_dir)
-    return results
+    try:
+        comm = ["fastqc", "--out", t_dir, filename]
+        out, err = Popen(comm, stdout=PIPE, stderr=PIPE).communicate()
+        reports = glob.glob(os.path.join(t_dir, "*_fastqc.zip"))
+        if 'Exception' in err or not reports:
+            return {"fastqc_error": err, "error" : ["fastqc_error"]}
+        with zipfile.ZipFile(reports[0]) as z:
+            fqc_file = [x for x in z.namelist()
+                        if x.endswith("/fastqc_data.txt")][0]
+            return parse_fastqc(z.open(fqc_file))
+    except Exception as e:
+        return {"fastqc_error": unicode(e), "error" : ["fastqc_error"]}
+    finally:
+        shutil.rmtree(t_dir, ignore_errors=True)
+
+
+def timed_fastqc(filename):
+    # FastQC results and the wall time of the job.
+    start = time.time()
+    return fastqc(filename), {"wall": time.time() - start}
+
+
+class fastqc_scheduler:
+    """
+        Run FastQC in the background while fastqs are hashed and
+        profiled, with at most `budget` FastQC jobs at a time.
+    """
+
+    def __init__(self, budget=1):
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(budget)
+        self.pending = []
+        self.submitted = set()
+        self.timings = []
+
+    def submit(self, fastq, hash):
+        # Duplicate fastqs share a hash and are only run once.
+        if hash in self.submitted:
+            return
+        self.submitted.add(hash)
+        if verbose:
+            report(os.path.basename(fastq) + "\t[ ] Running Fastqc")
+        self.pending.append((fastq, hash, self.pool.apply_async(timed_fastqc, (fastq,))))
+
+    def finished(self, wait=False):
+        """
+            Return (fastq, hash, results) for completed jobs,
+            waiting for every job if `wait` is set. Their
+            timings are added to self.timings.
+        """
+        done = [x for x in self.pending if wait or x[2].ready()]
+        self.pending = [x for x in self.pending if x not in done]
+        results = []
+        for fastq, hash, job in done:
+            fqc_data, timings = job.get()
+            self.timings.append((fastq, hash, timings))
+            results.append((fastq, hash, fqc_data))
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
 
 def test_fastqc(filename):
-    return filename.endswith(".fq.gz") or filename.endswith(".fastq.gz")
+    # FastQC reads gzip, bzip2 and uncompressed fastqs.
+    from fq.compression import BGZF, BZIP2, GZIP, PLAIN, file_format
+    try:
+        return file_format(filename) in (GZIP, BGZF, BZIP2, PLAIN)
+    except IOError:
+        return False
+
+
+# Datastore batching and retries.
+BATCH_SIZE = 100
+RETRIES = 5
+BACKOFF = 0.5
+# Seconds after which finished profiles are stored, even if
+# fewer than a batch have finished.
+FLUSH_INTERVAL = 60
+
+
+def retry(fn, *args, **kwargs):
+    """
+        Call a Datastore function, retrying with exponential
+        backoff if it raises one of the transient errors of
+        the backend. Other errors are raised at once.
+    """
+    for attempt in range(RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except ds.transient_errors as e:
+            if attempt == RETRIES - 1:
+                raise
+            report("Datastore error ({e}); retrying".format(e=e), "red")
+            time.sleep(BACKOFF * 2 ** attempt)
+
+
+def batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
 
+def iter_batches(items, batch_size):
+    # Batches of an iterator, read as they are used.
+    items = iter(items)
+    return iter(lambda: list(islice(items, batch_size)), [])
 
-def get_item(kind, name):
+
+# Local cache of entities and query results (set in main).
+cache = None
+
+
+def get_item(kind, name, cached=False):
+    if cached:
+        return get_items(kind, [name], cached=True).get(name)
     return ds.get(ds.key(kind, name))
 
 
-exclude_indices = ['most_abundant_sequence',
-                   'fastqc_per_base_sequence_quality_data',
+def get_items(kind, names, batch_size=BATCH_SIZE, cached=False):
+    """
+        Fetch entities with get_multi in batches.
+        Returns a dictionary of name: entity for those found.
+        With `cached`, entities in the local cache are used and
+        those fetched are added to it.
+    """
+    names = list(set(names))
+    cached_items = {}
+    if cached and cache is not None:
+        cached_items = cache.get_entities(kind, names)
+        names = [name for name in names if name not in cached_items]
+    found = {}
+    for batch in batches(names, batch_size):
+        keys = [ds.key(kind, name) for name in batch]
+        attempt = 0
+        while keys:
+            # Keys Datastore could not look up are returned as deferred.
+            deferred = []
+            for item in retry(ds.get_multi, keys, deferred=deferred):
+                found[item.key.name] = item
+            keys = deferred
+            if keys:
+                time.sleep(BACKOFF * 2 ** attempt)
+                attempt += 1
+    if cached and cache is not None:
+        cache.put_entities(kind, found.values())
+    found.update(cached_items)
+    return found
+
+
+def invalidate(kind, names=None):
+    # Drop cached entities (all if names is None) and queries of a kind.
+    if cache is not None:
+        cache.invalidate(kind, names)
+
+
+# Properties omitted from fetch, dump and query output.
+output_excluded = ['fastqc_per_base_sequence_quality_data',
                    'fastqc_per_tile_sequence_quality_data',
                    'fastqc_per_sequence_quality_scores_data',
                    'fastqc_per_base_sequence_content_data',
@@ -87,17 +249,24 @@ exclude_indices = ['most_abundant_sequence',
                    'fastqc_overrepresented_sequences_data',
                    'fastqc_adapter_content_data',
                    'fastqc_kmer_content_data',
-                   'fastqc_error']
-
+                   'fastqc_error',
+                   'barcode_counts_data',
+                   'tile_counts_data']
 
-def update_item(kind, name, **kwargs):
-    item = get_item(kind, name)
-    if item is None:
-        m = datastore.Entity(key=ds.key(kind, name),
-                             exclude_from_indexes=exclude_indices)
-    else:
-        m = datastore.Entity(key=ds.key(kind, name),
-                             exclude_from_indexes=exclude_indices)
+# Properties that are not indexed.
+exclude_indices = ['most_abundant_sequence',
+                   'sample_most_abundant_sequence',
+                   'profile_timings'] + output_excluded
+
+
+def merge_item(kind, name, item, kwargs, count=True):
+    """
+        Merge new data into an entity (or None). Lists are unioned,
+        the earliest date_created is kept and fq_profile_count
+        is incremented, unless `count` is unset.
+    """
+    m = ds.entity(ds.key(kind, name), exclude_indices)
+    if item is not None:
         m.update(dict(item))
     for key, value in kwargs.items():
         if not value and key in m:
@@ -111,83 +280,435 @@ def update_item(kind, name, **kwargs):
                 m[key] = value
             m[key] = list(set(m[key]))
         # If date created of file is earlier
-        elif key == 'date_created' and item:
+        elif key == 'date_created' and 'date_created' in m:
             vtimestamp = time.mktime(value.timetuple())
             dstimestamp = time.mktime(m['date_created'].timetuple())
             if vtimestamp < dstimestamp:
                 m[key] = value
         else:
             m[key] = value
+    if not count:
+        return m
     if 'fq_profile_count' in m:
         m['fq_profile_count'] += 1
     else:
         m['fq_profile_count'] = 1
-    ds.put(m)
+    return m
+
+
+# Summary totals are maintained overall and for these properties.
+aggregate_groups = ['instrument', 'run_id', 'flowcell_id']
+
+
+def aggregate_kind(kind):
+    return kind + "_summary"
+
+
+def aggregate_delta(deltas, item, sign):
+    """
+        Add (sign=1) or remove (sign=-1) the contribution of an
+        entity to the aggregates it belongs to.
+    """
+    if item is None:
+        return
+    names = [("all", None)]
+    for group in aggregate_groups:
+        if group in item:
+            names.append((group, item[group]))
+    for group, value in names:
+        name = group if value is None else group + ":" + unicode(value)
+        d = deltas.setdefault(name, {"group": group, "value": value,
+                                     "count": 0, "bases": 0, "filesize": 0})
+        d["count"] += sign
+        d["bases"] += sign * item.get("bases", 0)
+        d["filesize"] += sign * item.get("filesize", 0)
+
+
+def aggregate_entities(kind, deltas, batch_size, reset=False):
+    """
+        Apply aggregate deltas, returning the entities to put.
+    """
+    akind = aggregate_kind(kind)
+    current = {} if reset else get_items(akind, deltas.keys(), batch_size)
+    entities = []
+    for name, d in deltas.items():
+        m = ds.entity(ds.key(akind, name))
+        if name in current:
+            m.update(dict(current[name]))
+        else:
+            m.update({"group": d["group"], "value": d["value"],
+                      "count": 0, "bases": 0, "filesize": 0})
+        for k in ["count", "bases", "filesize"]:
+            m[k] += d[k]
+        entities.append(m)
+    return entities
+
+
+def update_aggregates(kind, deltas, batch_size=BATCH_SIZE):
+    """
+        Apply aggregate deltas in a transaction, so that
+        concurrent updates of a summary are not lost.
+    """
+    with ds.transaction():
+        ds.put_multi(aggregate_entities(kind, deltas, batch_size))
+
+
+def update_items(kind, updates, batch_size=BATCH_SIZE, count=True):
+    """
+        Apply a list of (name, kwargs) updates with one get_multi
+        and one put_multi per batch, then update the summary
+        aggregates of the batch in a transaction. With `count`
+        unset, fq_profile_count is left as it is.
+    """
+    for batch in batches(updates, batch_size):
+        items = get_items(kind, [name for name, kwargs in batch], batch_size)
+        deltas = {}
+        # The same name may be updated more than once in a batch.
+        for name, kwargs in batch:
+            aggregate_delta(deltas, items.get(name), -1)
+            items[name] = merge_item(kind, name, items.get(name), kwargs, count)
+            aggregate_delta(deltas, items[name], 1)
+        try:
+            retry(ds.put_multi, items.values())
+            retry(update_aggregates, kind, deltas, batch_size)
+        finally:
+            invalidate(kind, items.keys())
+            invalidate(aggregate_kind(kind), deltas.keys())
+
+
+def rebuild_aggregates(kind, batch_size=BATCH_SIZE):
+    """
+        Recalculate summary aggregates from every entity.
+    """
+    deltas = {}
+    # Existing aggregates are reset to zero.
+    for x in query_item(aggregate_kind(kind)):
+        deltas[x.key.name] = {"group": x["group"], "value": x["value"],
+                              "count": 0, "bases": 0, "filesize": 0}
+    for item in query_item(kind):
+        aggregate_delta(deltas, item, 1)
+    entities = aggregate_entities(kind, deltas, batch_size, reset=True)
+    try:
+        for batch in batches(entities, batch_size):
+            retry(ds.put_multi, batch)
+    finally:
+        invalidate(aggregate_kind(kind))
+
+
+def update_item(kind, name, **kwargs):
+    update_items(kind, [(name, kwargs)])
 
 
 def store_item(kind, name, **kwargs):
-    m = datastore.Entity(key=ds.key(kind, name))
+    m = ds.entity(ds.key(kind, name))
     for key, value in kwargs.items():
         if type(value) == str:
             m[key] = unicode(value)
         else:
             m[key] = value
-    ds.put(m)
+    try:
+        ds.put_multi([m])
+    finally:
+        invalidate(kind, [name])
 
 
-def query_item(kind, filters=None, projection=()):
+def query_item(kind, filters=None, projection=(), cached=False):
     # filters:
     # [("var_name", "=", 1)]
-    query = ds.query(kind=kind, projection = projection)
-    if filters:
-        for var, op, val in filters:
-            query.add_filter(var, op, val)
-    return query.fetch()
+    if cached and cache is not None:
+        query = lambda: iter_batches(ds.query(kind, filters, projection), BATCH_SIZE)
+        return (x for page in cached_pages(kind, query, BATCH_SIZE, filters, projection)
+                for x in page)
+    return ds.query(kind, filters, projection)
+
+
+def query_pages(kind, filters=None, page_size=BATCH_SIZE, cached=False):
+    """
+        Yield lists of at most page_size entities. With `cached`,
+        cached results are read back a page at a time, or pages
+        are cached as they are read.
+    """
+    query = lambda: ds.query_pages(kind, filters, page_size)
+    if not cached or cache is None:
+        return query()
+    return cached_pages(kind, query, page_size, filters)
+
+
+def cached_pages(kind, query, page_size, filters=None, projection=()):
+    """
+        Yield the cached pages of a query, or the pages of
+        `query()`, caching them. Cached pages evicted while being
+        read are continued from `query()`, which returns results
+        in the same (key) order.
+    """
+    pages = cache.get_pages(kind, filters, projection)
+    if pages is None:
+        pages = cache.cache_pages(kind, query(), filters, projection)
+    read = 0
+    try:
+        for page in pages:
+            for part in batches(page, page_size):
+                yield part
+            read += len(page)
+        return
+    except cache_miss:
+        pass
+    for page in query():
+        skip = min(read, len(page))
+        read -= skip
+        if page[skip:]:
+            yield page[skip:]
+
+
+def tsv_value(value):
+    if value is None:
+        return ""
+    elif type(value) == list:
+        return ",".join(map(tsv_value, value))
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    elif type(value) == float:
+        return repr(value)
+    return unicode(value)
+
+
+def fastqc_rows(item, fastqc_group, columns=()):
+    """
+        Yield the rows of a stored FastQC (or header) table as
+        tab-separated text.
+    """
+    if item is None or fastqc_group not in item:
+        return
+    from fq.fastqc_table import fastqc_table
+    table = fastqc_table(item[fastqc_group], columns)
+    for row in table.rows():
+        yield '\t'.join(map(tsv_value, row))
+
+
+def dump_items(pages, fmt="json", fields=None):
+    """
+        Write pages of entities to stdout as they are fetched, as a
+        JSON array, newline-delimited JSON or TSV. FastQC tables are
+        omitted and `fields` selects the properties written. TSV
+        columns default to the properties of the first entity.
+    """
+    comma = ""
+    header = False
+    if fmt == "json":
+        print("[")
+    for page in pages:
+        for i in page:
+            for j in output_excluded:
+                if j in i:
+                    del i[j]
+            i['md5sum'] = i.key.name
+            if fields:
+                i = {k: i.get(k) for k in fields}
+            if fmt == "json":
+                print(comma + json.dumps(i, default=json_serial, indent=4, sort_keys=True))
+                comma = ","
+            elif fmt == "ndjson":
+                print(json.dumps(i, default=json_serial, sort_keys=True))
+            elif fmt == "tsv":
+                if fields is None:
+                    fields = sorted(i.keys())
+                if not header:
+                    print('\t'.join(fields))
+                    header = True
+                print('\t'.join([tsv_value(i.get(k)) for k in fields]))
+        sys.stdout.flush()
+    if fmt == "json":
+        print("]")
 
 
-def md5sum(src, length=io.DEFAULT_BUFFER_SIZE):
-    calculated = 0
+def progress_callback(filesize):
+    """
+        Return a progress bar and a callback that updates it
+        (None for empty files or within pool workers).
+    """
+    if messages is not None or not filesize:
+        return None, None
+    progress_bar = progress.Bar(expected_size=filesize)
+    return progress_bar, progress_bar.show
+
+
+def md5sum(src, length=None, digests=()):
+    """
+        Hash a file in blocks of `length` (BLOCK_SIZE by default),
+        updating any additional hashlib-like digests (e.g. a
+        tree_hash) in the same read.
+    """
+    from fq.fq_util import BLOCK_SIZE, read_chunks, digest_chunks
     md5 = hashlib.md5()
-    with io.open(src, mode="rb") as fd:
-        filesize = os.stat(src).st_size
-        expected_size = (filesize / io.DEFAULT_BUFFER_SIZE) + 1
-        for chunk in progress.bar(iter(lambda: fd.read(length), b''),
-                                  expected_size=expected_size):
-            md5.update(chunk)
-            calculated += len(chunk)
+    progress_bar, callback = progress_callback(os.stat(src).st_size)
+    for chunk in digest_chunks(read_chunks(src, length or BLOCK_SIZE),
+                               [md5] + list(digests),
+                               callback):
+        pass
+    if progress_bar:
+        progress_bar.done()
     return md5
 
 
+def profile_checkpoint(fastq, interval):
+    """
+        Checkpoint for profiling a fastq, named after its path,
+        device, inode, size and modification time so that it is
+        only resumed while the file is unchanged.
+    """
+    from fq.fq_util import checkpoint
+    if not interval:
+        return None
+    file_stat = os.stat(fastq)
+    identity = "\t".join(map(str, [os.path.realpath(fastq),
+                                   file_stat.st_dev,
+                                   file_stat.st_ino,
+                                   file_stat.st_size,
+                                   file_stat.st_mtime]))
+    dirname = os.path.dirname(fqprofile.__file__) + "/.checkpoints"
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        pass
+    return checkpoint(dirname + "/" + hashlib.md5(identity).hexdigest(),
+                      interval)
+
+
 class checksums:
-    def __init__(self):
-        self.hashes = {}
+    """
+        Cache of file hashes stored in SQLite. Entries are keyed by
+        real path and are only used while the device, inode, size
+        and modification time of the file are unchanged. Hashes
+        whose profiles have been stored are recorded for `store`
+        (the backend, project and kind), so that `fq scan` can skip
+        them without a Datastore lookup.
+    """
+
+    def __init__(self, db=None, store=None):
+        if db is None:
+            db = os.path.dirname(fqprofile.__file__) + "/.checksum.db"
+        import sqlite3
+        self.db = sqlite3.connect(db, timeout=60)
+        self.db.text_factory = str
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS checksum (filename TEXT PRIMARY KEY,
+                                                 device INTEGER,
+                                                 inode INTEGER,
+                                                 size INTEGER,
+                                                 mtime REAL,
+                                                 md5 TEXT NOT NULL,
+                                                 tree_hash TEXT);
+            CREATE TABLE IF NOT EXISTS checksum_import (checksum_file TEXT PRIMARY KEY,
+                                                        mtime REAL);
+            CREATE TABLE IF NOT EXISTS profiled (store TEXT,
+                                                 md5 TEXT,
+                                                 fastqc INTEGER,
+                                                 PRIMARY KEY (store, md5));
+        """)
+        self.imported = set()
+        self.store = store
+
+    def import_checksum_file(self, dirname):
+        """
+            Import a legacy .checksum file. Files modified after
+            the .checksum file was written are left out, so that
+            they are hashed again.
+        """
+        checksum_file = dirname + "/.checksum"
+        self.imported.add(dirname)
+        if not os.path.exists(checksum_file):
+            return
+        mtime = os.stat(checksum_file).st_mtime
+        row = self.db.execute("SELECT mtime FROM checksum_import WHERE checksum_file = ?",
+                              (checksum_file,)).fetchone()
+        if row and row[0] == mtime:
+            return
+        rows = []
+        for line in open(checksum_file, 'r').read().splitlines():
+            try:
+                hash, filename = line.strip().split("\t")
+                st = os.stat(filename)
+            except (ValueError, OSError):
+                continue
+            if st.st_mtime > mtime:
+                continue
+            rows.append((filename, st.st_dev, st.st_ino, st.st_size, st.st_mtime, hash))
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO checksum VALUES (?, ?, ?, ?, ?, ?, NULL)", rows)
+            self.db.execute("INSERT OR REPLACE INTO checksum_import VALUES (?, ?)",
+                            (checksum_file, mtime))
+
+    def _lookup(self, filename, st=None):
+        # With `st`, filename must be a real path and is not stat'ed.
+        if st is None:
+            filename = os.path.realpath(filename)
+        base_dir = os.path.dirname(filename)
+        if base_dir not in self.imported:
+            self.import_checksum_file(base_dir)
+        row = self.db.execute("SELECT device, inode, size, mtime, md5, tree_hash FROM checksum WHERE filename = ?",
+                              (filename,)).fetchone()
+        if row is None:
+            return None
+        if st is None:
+            st = os.stat(filename)
+        if tuple(row[:4]) != (st.st_dev, st.st_ino, st.st_size, st.st_mtime):
+            return None
+        return row[4:]
+
+    def get_checksum(self, filename, tree=False, st=None):
+        """
+            Return the cached hash of a file, or None if it has
+            not been hashed or has changed since. With `tree`, a
+            tree hash must be cached as well. A stat result of the
+            real path may be given in `st` to save a stat call.
+        """
+        row = self._lookup(filename, st)
+        if row is None or (tree and row[1] is None):
+            return None
+        return row[0]
+
+    def get_tree_hash(self, filename):
+        row = self._lookup(filename)
+        if row:
+            return row[1]
+
+    def update_checksum(self, filename, hash, tree_hash=None):
+        filename = os.path.realpath(filename)
+        st = os.stat(filename)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO checksum VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (filename, st.st_dev, st.st_ino, st.st_size, st.st_mtime, hash, tree_hash))
+
+    def profiled_hashes(self, fastqc=False):
+        """
+            Return the hashes with stored profiles (and FastQC
+            results, with `fastqc`).
+        """
+        rows = self.db.execute("SELECT md5 FROM profiled WHERE store = ? AND fastqc >= ?",
+                               (self.store, int(fastqc)))
+        return set(row[0] for row in rows)
+
+    def mark_profiled(self, hashes, fastqc=False):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO profiled VALUES (?, ?, 0)",
+                                [(self.store, hash) for hash in hashes])
+            if fastqc:
+                self.db.executemany("UPDATE profiled SET fastqc = 1 WHERE store = ? AND md5 = ?",
+                                    [(self.store, hash) for hash in hashes])
 
     def get_or_update_checksum(self, filename):
-        filename = os.path.realpath(filename)
         basename = os.path.basename(filename)
-        base_dir = os.path.dirname(filename)
-        checksum_file = base_dir + "/.checksum"
-        if os.path.exists(checksum_file):
-            hash_set = open(checksum_file, 'r').readlines()
-            hash_set = [x.strip().split("\t") for x in hash_set]
-            hash_set = {v: k for k, v in hash_set}
-            self.hashes.update(hash_set)
-
-        if filename in self.hashes.keys():
+        hash = self.get_checksum(filename)
+        if hash:
             if verbose:
-                puts_err(colored.blue("\n" + basename + "\t[x] Using cached hash"))
+                report("\n" + basename + "\t[x] Using cached hash")
         else:
             if verbose:
-                puts_err(colored.blue("\n" + basename + "\t[ ] Generating hash"))
-
-        if filename not in self.hashes.keys():
-            hash = md5sum(filename).hexdigest()
-            self.hashes.update({filename: hash})
+                report("\n" + basename + "\t[ ] Generating hash")
             # Generate hash if it does not exist
-            self.hashes.update({filename: hash})
-            out = hash + "\t" + filename + "\n"
-            open(checksum_file, 'a').write(out)
-        return self.hashes[filename]
+            hash = md5sum(filename).hexdigest()
+            self.update_checksum(filename, hash)
+        return hash
 
 
 # Stack Overflow: 1094841
@@ -199,6 +720,419 @@ def file_size(size):
     return '{:.4g} {}'.format(size / (1 << (order * 10)), _suffixes[order])
 
 
+# Messages from pool workers are buffered and reported by the parent.
+messages = None
+
+
+def report(msg, color="blue"):
+    if messages is None:
+        puts_err(getattr(colored, color)(msg))
+    else:
+        messages.append((color, msg))
+
+
+def load_description(dirname):
+    description_filename = dirname + "/.description"
+    if not os.path.exists(description_filename):
+        return {}
+    try:
+        with indent(4):
+            puts_err(colored.blue("\nUsing .description file: " + description_filename + "\n"))
+        desc = dict([x.strip().split(":",1) for x in open(description_filename, 'r').read().splitlines()])
+        for k,v in desc.items():
+            desc[k] = autoconvert(v.strip())
+        return desc
+    except:
+        with indent(4):
+            puts_err(colored.red("\nError with .description file:" + description_filename + "\n"))
+        return {}
+
+
+def load_fqdata(dirname):
+    fqdata_filename = dirname + "/.fqdata"
+    if not os.path.exists(fqdata_filename):
+        return {}
+    try:
+        fq_group = {}
+        with indent(4):
+            puts_err(colored.blue("\nUsing .fqdata: " + fqdata_filename + "\n"))
+        fqdata = open(fqdata_filename, 'r').read().splitlines()
+        header = fqdata[0].strip().split("\t")[1:]
+        for line in fqdata[1:]:
+            line = line.split("\t")
+            values = [autoconvert(v.strip()) for v in line[1:]]
+            fq_group[line[0]] = dict(zip(header, values))
+        return fq_group
+    except:
+        with indent(4):
+            puts_err(colored.red("\nError with .fqdata file:" + fqdata_filename + "\n"))
+        return {}
+
+
+def profile_fastq(fastq, hash, tree, nfq, args, kind, hostname, description, fqdata,
+                  scanned=None, timings=None):
+    """
+        Hash and profile a single fastq. `hash` and `tree` are
+        cached hashes (or None) and `nfq` the stored entity for a
+        cached hash. `scanned` holds the hash, tree hash, reader
+        and stats of a fastq already read along with its mate,
+        and `timings` the phase_timings of that read.
+
+        Returns the fastq, its hash and tree hash (if requested),
+        whether the hashes were newly generated, the data to
+        store (None if the fastq could not be read), whether
+        FastQC should be run and the timings of each phase.
+    """
+    from fq.fq_util import fastq_reader, scan_fastq, sample_fastq, tree_hash
+    from fq.fq_util import sample_fields
+    fastq_realpath = os.path.realpath(fastq)
+    basename = os.path.basename(fastq_realpath)
+    filesize = os.path.getsize(fastq_realpath)
+    new_hash = hash is None
+    timings = timings or phase_timings()
+    calls = ds.snapshot() if isinstance(ds, datastore_calls) else None
+    if verbose:
+        if new_hash:
+            report("\n" + basename + "\t[ ] Generating hash")
+        else:
+            report("\n" + basename + "\t[x] Using cached hash")
+    sketch_memory = int(args["--sketch-memory"]) * 1024 * 1024
+    sample = args["--sample"]
+    stats = None
+    if scanned:
+        hash, scanned_tree, fq, stats = scanned
+        tree = scanned_tree or tree
+        if new_hash:
+            nfq = get_item(kind, hash)
+    elif new_hash:
+        digests = [hashlib.md5()]
+        if args["--tree-hash"]:
+            tree = tree_hash()
+            digests.append(tree)
+        if sample:
+            # Only the hash needs the whole file.
+            with timings.phase("hash", filesize):
+                digests[0] = md5sum(fastq_realpath, digests=digests[1:])
+            with timings.phase("sniff"):
+                fq = fastq_reader(fastq_realpath)
+        else:
+            # Hash, sniff and profile the fastq in a single read.
+            progress_bar, callback = progress_callback(os.stat(fastq).st_size)
+            with timings.phase("scan", filesize):
+                fq, stats = scan_fastq(fastq_realpath,
+                                       args["--exact-duplicates"],
+                                       sketch_memory,
+                                       digests,
+                                       callback,
+                                       args["--qc"],
+                                       profile_checkpoint(fastq_realpath,
+                                                          int(args["--checkpoint"])),
+                                       int(args["--split"]))
+            if progress_bar:
+                progress_bar.done()
+        hash = digests[0].hexdigest()
+        if tree:
+            tree = tree.hexdigest()
+        nfq = get_item(kind, hash)
+    else:
+        with timings.phase("sniff"):
+            fq = fastq_reader(fastq_realpath)
+    file_timings = {"phases": timings.result()}
+    if calls is not None:
+        file_timings["datastore"] = ds.since(calls)
+    if fq.error is True:
+        report("\n    Does not appear to be a Fastq: " +
+               fastq_realpath + "\n", "red")
+        return fastq, hash, tree, new_hash, None, False, file_timings
+
+    kwdata = {}
+    # A full profile replaces a sampled one.
+    upgrade = not sample and nfq is not None and u"sample_method" in nfq.keys()
+    # Test if fq stats (and QC tables, if requested) generated.
+    if nfq is None or u"total_reads" not in nfq.keys() or upgrade or \
+       (args["--qc"] and u"fastqc_per_base_sequence_quality_data" not in nfq.keys()):
+        if verbose:
+            report(basename + "\t[ ] Profiling")
+        kwdata.update(fq.header)
+        if stats is None and sample:
+            if verbose:
+                report(basename + "\t[ ] Sampling reads (" + sample + ")")
+            with timings.phase("sample"):
+                stats = sample_fastq(fastq_realpath,
+                                     sample,
+                                     int(args["--sample-reads"]),
+                                     args["--exact-duplicates"],
+                                     sketch_memory,
+                                     args["--qc"])
+        elif stats is None:
+            with timings.phase("stats", filesize):
+                stats = fq.calculate_fastq_stats(args["--exact-duplicates"],
+                                                 sketch_memory,
+                                                 args["--qc"],
+                                                 profile_checkpoint(fastq_realpath,
+                                                                    int(args["--checkpoint"])),
+                                                 int(args["--split"]))
+        if upgrade:
+            for k in sample_fields:
+                kwdata[k] = None
+        kwdata.update(stats)
+    else:
+        if verbose:
+            report(basename + "\t[x] Already profiled")
+
+    # Test if fastq filename matches illumina conventions
+    illumina_keys = None
+    i1 = re.match(r"([^_]+)_([ATGC]+)_([L0-9]{4})_([R12]{2})_([0-9]{3}).(fastq|fq).gz", basename)
+    i2 = re.match(r"([^_]+)_(S[0-9]+)_([L0-9]{4})_([R12]{2})_([0-9]{3}).(fastq|fq).gz", basename)
+    if i1:
+        r = i1
+        illumina_keys = ["illumina_filename_sample",
+                         "illumina_filename_barcode_sequence",
+                         "illumina_filename_lane",
+                         "illumina_filename_read",
+                         "illumina_filename_set_number"]
+    elif i2:
+        r = i2
+        illumina_keys = ["illumina_filename_sample",
+                         "illumina_filename_sample_number",
+                         "illumina_filename_lane",
+                         "illumina_filename_read",
+                         "illumina_filename_set_number"]
+    if illumina_keys:
+        report(basename + "\tIllumina Filename")
+        illumina_values = map(autoconvert, r.groups())
+        illumina_data = dict(zip(illumina_keys, illumina_values))
+        kwdata.update(illumina_data)
+
+    # File statistics
+    file_stat = os.stat(fastq)
+    kwdata['filesize'] = file_stat.st_size
+    kwdata['hfilesize'] = file_size(file_stat.st_size)
+    date_created = file_stat.st_ctime
+    kwdata['date_created'] = datetime.fromtimestamp(date_created)
+
+    # Add custom data
+    if args['--kv']:
+        if verbose:
+            report(basename + "\tStoring Custom data")
+        kv = [x.split(":") for x in args['--kv'].split(",")]
+        kv = {k: autoconvert(v) for k, v in kv}
+        kwdata.update(kv)
+
+    # .description and .fqdata
+    kwdata.update(description)
+    if basename in fqdata:
+        kwdata.update(fqdata[basename])
+    elif hash in fqdata:
+        kwdata.update(fqdata[hash])
+
+    # FastQC is scheduled by the caller; fastqs with a cached hash
+    # are checked before profiling starts.
+    run_fastqc = args["--fastqc"] and new_hash and needs_fastqc(fastq, nfq)
+
+    if tree:
+        kwdata[tree_hash.name] = tree
+    kwdata['hostname'] = [hostname]
+    kwdata['basename'] = [unicode(basename)]
+    kwdata['filename'] = [unicode(fastq_realpath)]
+    if calls is not None:
+        file_timings["datastore"] = ds.since(calls)
+    if args["--store-timings"]:
+        kwdata['profile_timings'] = unicode(json.dumps(file_timings))
+    return fastq, hash, tree, new_hash, kwdata, run_fastqc, file_timings
+
+
+def needs_fastqc(fastq, nfq):
+    """
+        Test whether FastQC results are missing from a stored entity.
+    """
+    basename = os.path.basename(fastq)
+    if nfq is not None and u'fastqc_error' in nfq.keys():
+        report(basename + "\t[x] FastQC run previously and errored")
+        return False
+    elif nfq is None or u"fastqc_version" not in nfq.keys():
+        return True
+    if verbose:
+        report(basename + "\t[x] FastQC already run")
+    return False
+
+
+def store_fastqc(kind, results, batch_size):
+    """
+        Store (fastq, hash, results) from FastQC jobs in batches.
+        They complete a profile, so are not counted as another.
+    """
+    update_items(kind,
+                 [(hash, fqc_data) for fastq, hash, fqc_data in results],
+                 batch_size,
+                 count=False)
+    ck.mark_profiled([hash for fastq, hash, fqc_data in results], fastqc=True)
+    for fastq, hash, fqc_data in results:
+        basename = os.path.basename(fastq)
+        if 'fastqc_error' in fqc_data.keys():
+            puts_err(colored.red(basename + "\tError running FastQC"))
+            puts_err(colored.red(fqc_data['fastqc_error']))
+        else:
+            puts_err(colored.blue(basename + "\tFastQC Complete"))
+
+
+def store_profiles(kind, profiles, batch_size, fastqc_submitted=None):
+    """
+        Store (fastq, hash, kwdata, progress) results in batches
+        and report them as complete. With `fastqc_submitted`
+        (hashes sent to FastQC), the others are recorded as
+        already having FastQC results.
+    """
+    update_items(kind,
+                 [(hash, kwdata) for fastq, hash, kwdata, progress_str in profiles],
+                 batch_size)
+    hashes = [hash for fastq, hash, kwdata, progress_str in profiles]
+    ck.mark_profiled(hashes)
+    if fastqc_submitted is not None:
+        ck.mark_profiled([hash for hash in hashes if hash not in fastqc_submitted],
+                         fastqc=True)
+    for fastq, hash, kwdata, progress_str in profiles:
+        puts_err(colored.blue(os.path.basename(fastq) + "\tComplete" + progress_str))
+
+
+def write_timings(f, d):
+    # One JSON line per file, FastQC job or run.
+    f.write(json.dumps(d) + "\n")
+    f.flush()
+
+
+def init_worker(settings, args):
+    global ds
+    global verbose
+    ds = lazy_backend(settings)
+    if args["--timings"] or args["--store-timings"]:
+        ds = datastore_calls(ds)
+    verbose = args["--verbose"]
+
+
+def scan_fastqs(roots, threads, fastqc=False, tree=False):
+    """
+        Find the fastqs under `roots` that are new or have changed
+        since they were profiled, comparing stat results with the
+        checksum cache. Unchanged fastqs are skipped without any
+        Datastore lookup. Returns the sorted paths to profile.
+    """
+    from fq.scan import walk_fastqs
+    profiled = ck.profiled_hashes(fastqc)
+    seen = set()
+    fq_set = []
+    for path, st in walk_fastqs(roots, threads):
+        # Symlinks and overlapping roots find the same fastq again.
+        if path in seen:
+            continue
+        seen.add(path)
+        if ck.get_checksum(path, tree, st) not in profiled:
+            fq_set.append(path)
+    report("Scanned {n:,} fastqs: {unchanged:,} unchanged, {new:,} to profile".format(
+           n=len(seen), unchanged=len(seen) - len(fq_set), new=len(fq_set)))
+    return sorted(fq_set)
+
+
+# Mate file names: Illumina (<sample>_S1_L001_R1_001.fastq.gz)
+# and <name>_1.fq, <name>_R1.fq or <name>.1.fq.
+mate_patterns = [r"(.+_L[0-9]{3}_R)([12])(_[0-9]{3}\.(?:fastq|fq)\.gz)$",
+                 r"(.+[._]R?)([12])(\.(?:fastq|fq)(?:\.gz)?)$"]
+
+
+def pair_fastqs(fq_set):
+    """
+        Group fastqs into mates by file name. Returns lists of
+        one fastq or two mates (R1 first) in the order given.
+    """
+    mates = {}
+    for fastq in fq_set:
+        for pattern in mate_patterns:
+            m = re.match(pattern, os.path.basename(fastq))
+            if m:
+                key = (os.path.dirname(os.path.realpath(fastq)),
+                       m.group(1),
+                       m.group(3))
+                mates.setdefault(key, {})[m.group(2)] = fastq
+                break
+    paired = {}
+    for files in mates.values():
+        if len(files) == 2:
+            paired[files["1"]] = paired[files["2"]] = [files["1"], files["2"]]
+    units = []
+    for fastq in fq_set:
+        if fastq not in paired:
+            units.append([fastq])
+        elif paired[fastq][0] == fastq:
+            units.append(paired[fastq])
+    return units
+
+
+def profile_pair(tasks):
+    """
+        Profile two mates. Unless both already have pair stats,
+        they are hashed and profiled in one lockstep read which
+        compares read names and counts duplicate pairs. Pair stats
+        and the md5sum of the mate are stored on both fastqs.
+    """
+    from fq.fq_util import scan_pair, tree_hash
+    args = tasks[0][4]
+    if all(task[3] is not None and u"pair_reads" in task[3].keys()
+           for task in tasks):
+        return [profile_fastq(*task) for task in tasks]
+    fastqs = [os.path.realpath(task[0]) for task in tasks]
+    basenames = map(os.path.basename, fastqs)
+    if verbose:
+        report("\n" + " + ".join(basenames) + "\t[ ] Profiling pair")
+    digests = []
+    for task in tasks:
+        file_digests = [hashlib.md5()]
+        if args["--tree-hash"]:
+            file_digests.append(tree_hash())
+        digests.append(file_digests)
+    timings = phase_timings()
+    with timings.phase("scan_pair", sum(map(os.path.getsize, fastqs))):
+        scans, pair = scan_pair(fastqs,
+                                args["--exact-duplicates"],
+                                int(args["--sketch-memory"]) * 1024 * 1024,
+                                digests,
+                                args["--qc"])
+    hashes = [file_digests[0].hexdigest() for file_digests in digests]
+    results = []
+    for task, file_digests, (fq, stats), mate_hash in zip(tasks, digests, scans,
+                                                          reversed(hashes)):
+        tree = file_digests[1].hexdigest() if len(file_digests) > 1 else None
+        result = profile_fastq(*task, scanned=(file_digests[0].hexdigest(),
+                                               tree,
+                                               fq,
+                                               stats),
+                               timings=timings.copy())
+        if result[4] is not None:
+            result[4].update(pair)
+            result[4]['mate_md5sum'] = mate_hash
+        results.append(result)
+    if pair["pair_concordant_reads"] < pair["pair_reads"] or pair["pair_unpaired_reads"]:
+        report(" + ".join(basenames) + "\tMates out of sync: " +
+               "{pair_concordant_reads} of {pair_reads} pairs concordant, "
+               "{pair_unpaired_reads} unpaired reads".format(**pair), "red")
+    return results
+
+
+def profile_unit(unit):
+    # Profile a list of one fastq task or two mate tasks.
+    if len(unit) == 2:
+        return profile_pair(unit)
+    return [profile_fastq(*unit[0])]
+
+
+def profile_task(unit):
+    # Profile a fastq or a pair of mates within a pool worker.
+    global messages
+    messages = []
+    results = profile_unit(unit)
+    return [result + (messages if n == 0 else [],)
+            for n, result in enumerate(results)]
+
+
 def main():
     settings_file = os.path.dirname(fqprofile.__file__) + "/.config"
     try:
@@ -214,13 +1148,31 @@ def main():
                   version=__version__,
                   options_first=False)
 
+    if args["--cprofile"]:
+        # Profiles this process (not --jobs workers) until exit.
+        import atexit
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(lambda: (profiler.disable(),
+                                 profiler.dump_stats(args["--cprofile"])))
+        profiler.enable()
+
     # Save settings
     if args["set"]:
-        settings = {"project": args["<project>"], "kind": args["<kind>"]}
+        settings = {"project": args["<project>"],
+                    "kind": args["<kind>"],
+                    "backend": args["--backend"]}
+        if args["--backend"] not in ["datastore", "sqlite"]:
+            with indent(4):
+                exit(puts_err(colored.red("\nBackend must be datastore or sqlite\n")))
+        if args["--backend"] == "sqlite":
+            settings["db"] = os.path.abspath(args["--db"] or
+                                             os.path.expanduser("~/.fq/" + args["<project>"] + ".db"))
         open(settings_file, 'w').write(json.dumps(settings, indent=4))
         project = args["<project>"]
         kind = args["<kind>"]
-        output_str = "Project: {project} - Kind: {kind}".format(**locals())
+        backend = args["--backend"]
+        output_str = "Project: {project} - Kind: {kind} - Backend: {backend}".format(**locals())
         puts_err(colored.blue("\n{output_str} - Saved Settings".format(**locals())))
         exit()
 
@@ -228,17 +1180,28 @@ def main():
         with indent(4):
             exit(puts_err(colored.red("\nPlease set project and kind using 'fq set'\n")))
 
-
-    ck = checksums()
-    hostname = unicode(os.getlogin())
-
     global ds
+    global ck
+    global cache
     global verbose
-    global threads
     verbose = args["--verbose"]
-    threads = args["--fastqc-threads"]
 
-    ds = datastore.Client(project=project)
+    # Storage is opened when a command first uses it.
+    ds = lazy_backend(settings)
+    if args["--timings"] or args["--store-timings"]:
+        ds = datastore_calls(ds)
+
+    # Settings the profiled hashes in the checksum cache and
+    # cached entities belong to.
+    store = "\t".join([settings.get("backend", "datastore"),
+                       settings.get("db", ""),
+                       project,
+                       kind])
+    from fq.cache import entity_cache
+    cache = entity_cache(os.path.dirname(fqprofile.__file__) + "/.cache.db",
+                         store,
+                         int(args["--cache-ttl"]),
+                         int(args["--cache-size"]) * 1024 * 1024)
 
     if args["query"] or args["dump"]:
         if args["query"]:
@@ -257,73 +1220,113 @@ def main():
                 for i in filter_set:
                     puts_err(colored.blue(str(i)))
                 puts_err("\n")
-            fastq_dumped = query_item('fastq', filters = filter_set)
-        elif args["dump"]:
-            fastq_dumped = query_item(kind)
-        print("[")
-        comma = ""
-        for i in fastq_dumped:
-            for j in exclude_indices[1:]:
-                if j in i:
-                    del i[j]
-            i['md5sum'] = i.key.name
-            print(comma + json.dumps(i, default=json_serial, indent=4, sort_keys=True))
-            comma = ","
-        print("]")
+        else:
+            filter_set = None
+        if args["--format"] not in ["json", "ndjson", "tsv"]:
+            with indent(4):
+                exit(puts_err(colored.red("\nFormat must be json, ndjson or tsv\n")))
+        fields = None
+        if args["--fields"]:
+            fields = args["--fields"].split(",")
+        fastq_dumped = query_pages(kind, filter_set, int(args["--batch-size"]), cached=True)
+        dump_items(fastq_dumped, args["--format"], fields)
         exit()
 
     if args["summary"]:
-        bases = list(query_item(kind, projection=['bases']))
-        count = len(bases)
-        bases = sum([x['bases'] for x in bases])
-        filesize = list(query_item(kind, projection=['filesize']))
-        filesize = sum([x['filesize'] for x in filesize])
+        batch_size = int(args["--batch-size"])
+        summary = get_item(aggregate_kind(kind), "all", cached=True)
+        if args["--rebuild"] or summary is None:
+            puts_err(colored.blue("Rebuilding summary"))
+            rebuild_aggregates(kind, batch_size)
+            summary = get_item(aggregate_kind(kind), "all", cached=True) or \
+                      {"count": 0, "bases": 0, "filesize": 0}
         fm = """FASTQ count: {count:,}\nBases: {bases:,}\nfilesize: {filesize}\n"""
 
-        print fm.format(count=count,
-                        bases=bases,
-                        filesize=file_size(filesize))
+        print fm.format(count=summary["count"],
+                        bases=summary["bases"],
+                        filesize=file_size(summary["filesize"]))
+
+        if args["--by"]:
+            if args["--by"] not in aggregate_groups:
+                with indent(4):
+                    exit(puts_err(colored.red("\nSummaries are available by: " +
+                                              ", ".join(aggregate_groups) + "\n")))
+            print('\t'.join([args["--by"], "count", "bases", "filesize"]))
+            for i in query_item(aggregate_kind(kind),
+                                filters=[("group", "=", args["--by"])],
+                                cached=True):
+                if i["count"] > 0:
+                    print('\t'.join(map(unicode, [i["value"],
+                                                   i["count"],
+                                                   i["bases"],
+                                                   i["filesize"]])))
+        exit()
+
+    ck = checksums(store=store)
 
-    if "*" in args["<fq>"] and len(args) == 1:
-        fq_set = glob.glob(args["<fq>"])
+    if args["scan"]:
+        fq_set = scan_fastqs(args["<dir>"],
+                             int(args["--stat-threads"]),
+                             args["--fastqc"],
+                             args["--tree-hash"])
     elif "-" in args["<fq>"]:
         fq_set = [x.strip() for x in sys.stdin.readlines()]
     else:
-        fq_set = args["<fq>"]
+        # Patterns the shell left unexpanded (e.g. quoted, or too many
+        # files); kept as given if they match nothing.
+        fq_set = []
+        for pattern in args["<fq>"]:
+            if glob.has_magic(pattern) and not os.path.exists(pattern):
+                fq_set += sorted(glob.glob(pattern)) or [pattern]
+            else:
+                fq_set.append(pattern)
     fq_set_exists = map(os.path.isfile, fq_set)
-    fastqc_complient = map(test_fastqc, fq_set)
 
 
     if args["fastqc-dump"]:
-        fastqc_group = "fastqc_" + args["<fastqc-group>"] + "_data"
-        if args["<fastqc-group>"] not in fastqc_groups:
+        # Barcode and lane/tile tables from read headers are
+        # dumped like FastQC tables.
+        from fq.headers import header_tables
+        group = args["<fastqc-group>"]
+        if group in fastqc_groups:
+            fastqc_group = "fastqc_" + group + "_data"
+            columns = fastqc_headers[group]
+        elif group in header_tables:
+            fastqc_group = group + "_data"
+            columns = header_tables[group]
+        else:
             with indent(4):
                 puts_err(colored.blue("\nFastQC group not found. Available FastQC groups:\n\n" + 
-                                      '\n'.join(fastqc_groups) + "\n"))
+                                      '\n'.join(fastqc_groups + sorted(header_tables)) + "\n"))
                 exit()
 
         if fq_set:
             # Output header
-            print('\t'.join(['filename'] + fastqc_headers[args["<fastqc-group>"]]))
-            for i in fq_set:
-                hash = ck.get_or_update_checksum(i)
-                fastqc_data = get_item(kind, hash)[fastqc_group].splitlines()
-                out = '\n'.join([i + "\t" + x for x in fastqc_data])
-                print(out)
+            print('\t'.join(['filename'] + columns))
+            hashes = [(i, ck.get_or_update_checksum(i)) for i in fq_set]
+            fetched = get_items(kind,
+                                [hash for i, hash in hashes],
+                                int(args["--batch-size"]),
+                                cached=True)
+            for i, hash in hashes:
+                for row in fastqc_rows(fetched.get(hash), fastqc_group, columns):
+                    print(i + "\t" + row)
         else:
             # Output header
-            print('\t'.join(['hash', 'filename'] + fastqc_headers[args["<fastqc-group>"]]))
+            print('\t'.join(['hash', 'filename'] + columns))
             # If no fq specified, dump everything:
-            fastq_dumped = query_item(kind)
-            for i in fastq_dumped:
-                fastqc_data = i[fastqc_group].splitlines()
-                fnames = i.key.name + "\t" + i['filename'][0]
-                out = '\n'.join([fnames + "\t" + x for x in fastqc_data])
-                print(out)
+            for page in query_pages(kind, page_size=int(args["--batch-size"]), cached=True):
+                for i in page:
+                    fnames = i.key.name + "\t" + i['filename'][0]
+                    for row in fastqc_rows(i, fastqc_group, columns):
+                        print(fnames + "\t" + row)
         exit()
 
     if args["--fastqc"]:
         check_program_exists("fastqc")
+    if args["--sample"] not in [None, "head", "reservoir", "seek"]:
+        with indent(4):
+            exit(puts_err(colored.red("\nSample method must be head, reservoir or seek\n")))
     if not all(fq_set_exists):
         missing_files = [f for f, exists in zip(fq_set, fq_set_exists)
                          if exists is False]
@@ -331,36 +1334,39 @@ def main():
             puts_err(colored.red("\nFile not found:\n\n" +
                              "\n".join(missing_files) + "\n"))
             exit()
+    from fq.compression import missing_module
+    missing_modules = [(f, missing_module(f)) for f in fq_set]
+    missing_modules = [f + "\t" + module for f, module in missing_modules if module]
+    if missing_modules:
+        with indent(4):
+            puts_err(colored.red("\nModule needed to decompress not installed:\n\n" +
+                                 "\n".join(missing_modules) + "\n"))
+            exit()
 
 
-    error_fqs = []
+    batch_size = int(args["--batch-size"])
 
     if args["fetch"]:
+        from fq.fq_util import fastq_reader
+        hashes = []
+        for fastq in fq_set:
+            fastq_realpath = os.path.realpath(fastq)
+            hash = ck.get_or_update_checksum(fastq)
+            fq = fastq_reader(fastq_realpath)
+            if fq.error is True:
+                with indent(4):
+                    puts_err(colored.red("\nDoes not appear to be a Fastq: " +
+                         fastq_realpath + "\n"))
+                continue
+            hashes.append((fastq, hash))
+        fetched = get_items(kind, [hash for fastq, hash in hashes], batch_size, cached=True)
         print("[")
         comma = ""
-
-    # Dictionary for .description and .fqdata files
-    dot_description = {}
-    dot_fqdata = {}
-
-    for fastq in fq_set:
-        fastq_realpath = os.path.realpath(fastq)
-        basename = os.path.basename(fastq_realpath)
-        dirname = os.path.dirname(fastq_realpath)
-        hash = ck.get_or_update_checksum(fastq)
-        fq = fastq_reader(fastq_realpath)
-        if fq.error is True:
-            error_fqs.append(fastq)
-            with indent(4):
-                puts_err(colored.red("\nDoes not appear to be a Fastq: " +
-                     fastq_realpath + "\n"))
-            continue
-
-
-        if args["fetch"]:
-            i = get_item(kind, hash)
+        for fastq, hash in hashes:
+            basename = os.path.basename(fastq)
+            i = fetched.get(hash)
             if i:
-                for j in exclude_indices[1:]:
+                for j in output_excluded:
                     if j in i:
                         del i[j]
                 i['md5sum'] = i.key.name
@@ -371,141 +1377,151 @@ def main():
                 comma = ","
             else:
                 puts_err(colored.red("{basename} has not been profiled. Profile with 'fq profile'".format(basename=basename)))
-            continue
+        print("]")
+        exit()
 
-        nfq = get_item(kind, hash)
-        kwdata = {}
-        # Test if fq stats generated.
-        if nfq is None or u"total_reads" not in nfq.keys():
-            if verbose:
-                puts_err(colored.blue(basename + "\t[ ] Profiling"))
-            kwdata.update(fq.header)
-            kwdata.update(fq.calculate_fastq_stats())
-        else:
-            if verbose:
-                puts_err(colored.blue(basename + "\t[x] Already profiled"))
-
-        # Test if fastq filename matches illumina conventions
-        illumina_keys = None
-        i1 = re.match(r"([^_]+)_([ATGC]+)_([L0-9]{4})_([R12]{2})_([0-9]{3}).(fastq|fq).gz", basename)
-        i2 = re.match(r"([^_]+)_(S[0-9]+)_([L0-9]{4})_([R12]{2})_([0-9]{3}).(fastq|fq).gz", basename)
-        if i1:
-            r = i1
-            illumina_keys = ["illumina_filename_sample",
-                             "illumina_filename_barcode_sequence",
-                             "illumina_filename_lane",
-                             "illumina_filename_read",
-                             "illumina_filename_set_number"]
-        elif i2:
-            r = i2
-            illumina_keys = ["illumina_filename_sample",
-                             "illumina_filename_sample_number",
-                             "illumina_filename_lane",
-                             "illumina_filename_read",
-                             "illumina_filename_set_number"]
-        if illumina_keys:
-            puts_err(colored.blue(basename + "\tIllumina Filename"))
-            illumina_values = map(autoconvert, r.groups())
-            illumina_data = dict(zip(illumina_keys, illumina_values))
-            kwdata.update(illumina_data)
-
-        # File statistics
-        file_stat = os.stat(fastq)
-        kwdata['filesize'] = file_stat.st_size
-        kwdata['hfilesize'] = file_size(file_stat.st_size)
-        date_created = file_stat.st_ctime
-        kwdata['date_created'] = datetime.fromtimestamp(date_created)
-
-        # Add custom data
-        if args['--kv']:
-            if verbose:
-                puts_err(colored.blue(basename + "\tStoring Custom data"))
-            kv = [x.split(":") for x in args['--kv'].split(",")]
-            kv = {k: autoconvert(v) for k, v in kv}
-            kwdata.update(kv)
+    # Look up cached hashes and their entities in batches.
+    cached = {}
+    for fastq in fq_set:
+        cached[fastq] = (ck.get_checksum(fastq, tree=args["--tree-hash"]),
+                         ck.get_tree_hash(fastq))
+    entities = get_items(kind,
+                         [hash for hash, tree in cached.values() if hash],
+                         batch_size,
+                         cached=True)
 
-        # .description:
+    try:
+        hostname = unicode(os.getlogin())
+    except OSError:
+        # No controlling terminal, e.g. under a workflow manager.
+        import getpass
+        hostname = unicode(getpass.getuser())
+
+    # .description and .fqdata files are read once per directory
+    # and handed to each task.
+    run_start, run_cpu = time.time(), cpu_time()
+    dot_description = {}
+    dot_fqdata = {}
+    tasks = []
+    for fastq in fq_set:
+        dirname = os.path.dirname(os.path.realpath(fastq))
         if dirname not in dot_description:
-            description_filename = dirname + "/.description"
-            # Cache Description data in dot_description.
-            if os.path.exists(description_filename):
-                try:
-                    with indent(4):
-                        puts_err(colored.blue("\nUsing .description file: " + description_filename + "\n"))
-                    desc = dict([x.strip().split(":",1) for x in open(description_filename, 'r').read().splitlines()])
-                    for k,v in desc.items():
-                        desc[k] = autoconvert(v.strip())
-                    dot_description[dirname] = desc
-                except:
-                    with indent(4):
-                        puts_err(colored.red("\nError with .description file:" + description_filename + "\n"))
-                    dot_description[dirname] = {}
-            else:
-                dot_description[dirname] = {}
-        kwdata.update(dot_description[dirname])
+            dot_description[dirname] = load_description(dirname)
+        if dirname not in dot_fqdata:
+            dot_fqdata[dirname] = load_fqdata(dirname)
+        hash, tree = cached[fastq]
+        nfq = entities.get(hash)
+        if nfq is not None:
+            nfq = dict(nfq)
+        tasks.append((fastq, hash, tree, nfq, args, kind, hostname,
+                      dot_description[dirname], dot_fqdata[dirname]))
+
+    # FastQC runs alongside profiling. Fastqs with a cached hash
+    # start straight away, others once they have been hashed.
+    fastqc_submitted = None
+    if args["--fastqc"]:
+        scheduler = fastqc_scheduler(int(args["--fastqc-threads"]))
+        fastqc_submitted = scheduler.submitted
+        for fastq in fq_set:
+            hash, tree = cached[fastq]
+            if hash and needs_fastqc(fastq, entities.get(hash)):
+                scheduler.submit(fastq, hash)
+    fastqc_results = []
+
+    # Mates are profiled together.
+    if args["--paired"] and not args["--sample"]:
+        task_for = dict((task[0], task) for task in tasks)
+        units = [[task_for[fastq] for fastq in unit]
+                 for unit in pair_fastqs(fq_set)]
+    else:
+        units = [[task] for task in tasks]
 
+    jobs = int(args["--jobs"])
+    if jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs, init_worker, (settings, args))
+        results = pool.imap_unordered(profile_task, units)
+    else:
+        results = ([result + ([],) for result in profile_unit(unit)]
+                   for unit in units)
+    results = (result for unit_results in results for result in unit_results)
 
-        # .fqdata
-        if dirname not in dot_fqdata:
-            # Cache fqdata in dot_description.
-            fqdata_filename = dirname + "/.fqdata"
-            if os.path.exists(fqdata_filename):
-                try:
-                    fq_group = {}
-                    with indent(4):
-                        puts_err(colored.blue("\nUsing .fqdata: " + fqdata_filename + "\n"))
-                    fqdata = open(fqdata_filename, 'r').read().splitlines()
-                    header = fqdata[0].strip().split("\t")[1:]
-                    for line in fqdata[1:]:
-                        line = line.split("\t")
-                        values = [autoconvert(v.strip()) for v in line[1:]]
-                        fq_group[line[0]] = dict(zip(header, values))
-                    dot_fqdata[dirname] = fq_group
-                except:
-                    with indent(4):
-                        puts_err(colored.red("\nError with .fqdata file:" + fqdata_filename + "\n"))
-                    dot_fqdata[dirname] = {}                    
-            else:
-                dot_fqdata[dirname] = {}
-        if dirname in dot_fqdata:
-            if basename in dot_fqdata[dirname]:
-                kwdata.update(dot_fqdata[dirname][basename])
-            elif hash in dot_fqdata[dirname]:
-                kwdata.update(dot_fqdata[dirname][hash])
-
-        # FASTQC
+    error_fqs = []
+    profiles = []
+    timings_out = None
+    if args["--timings"]:
+        timings_out = open(args["--timings"], 'w')
+    # A walltime limit (SIGTERM) stores finished profiles as well.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    flushed = time.time()
+    try:
+        for n, (fastq, hash, tree, new_hash, kwdata, run_fastqc, timings, msgs) in enumerate(results, 1):
+            for color, msg in msgs:
+                puts_err(getattr(colored, color)(msg))
+            if timings_out:
+                write_timings(timings_out, dict(timings, type="file", file=fastq, md5sum=hash))
+            # The checksum cache is only written by this process.
+            if new_hash:
+                ck.update_checksum(fastq, hash, tree)
+            if kwdata is None:
+                error_fqs.append(fastq)
+                continue
+            if run_fastqc:
+                scheduler.submit(fastq, hash)
+            progress_str = ""
+            if jobs > 1:
+                progress_str = "\t[{n}/{total}]".format(n=n, total=len(tasks))
+            # Datastore writes are batched. FastQC results are stored
+            # after the profiles they belong to.
+            profiles.append((fastq, hash, kwdata, progress_str))
+            if args["--fastqc"]:
+                fastqc_results += scheduler.finished()
+            if len(profiles) >= batch_size or time.time() - flushed >= FLUSH_INTERVAL:
+                store_profiles(kind, profiles, batch_size, fastqc_submitted)
+                profiles = []
+                if fastqc_results:
+                    store_fastqc(kind, fastqc_results, batch_size)
+                    fastqc_results = []
+                flushed = time.time()
+    finally:
+        # Profiles finished before an error or interruption are kept.
+        if profiles:
+            store_profiles(kind, profiles, batch_size, fastqc_submitted)
         if args["--fastqc"]:
-            if nfq is not None and u'fastqc_error' in nfq.keys():
-                puts_err(colored.blue(basename + "\t[x] FastQC run previously and errored"))
-            elif  nfq is None or u"fastqc_version" not in nfq.keys():
-                if verbose:
-                    puts_err(colored.blue(basename + "\t[ ] Running Fastqc"))
-                fqc_data = fastqc(fastq)
-                if 'fastqc_error' in fqc_data.keys():
-                    puts_err(colored.red(basename + "\tError running FastQC"))
-                    puts_err(colored.red(fqc_data['fastqc_error']))
-                kwdata.update(fqc_data)
-            else:
-                if verbose:
-                    puts_err(colored.blue(basename + "\t[x] FastQC already run"))
-
-        filename = os.path.realpath(fastq)
-        kwdata['hostname'] = [hostname]
-        kwdata['basename'] = [unicode(basename)]
-        kwdata['filename'] = [unicode(fastq_realpath)]
-        update_item(kind,
-                    hash,
-                    **kwdata)
-        puts_err(colored.blue(basename + "\tComplete"))
+            fastqc_results += scheduler.finished()
+            for batch in batches(fastqc_results, batch_size):
+                store_fastqc(kind, batch, batch_size)
+            fastqc_results = []
+
+    if jobs > 1:
+        pool.close()
+        pool.join()
+
+    if args["--fastqc"]:
+        fastqc_results += scheduler.finished(wait=True)
+        scheduler.close()
+        for batch in batches(fastqc_results, batch_size):
+            store_fastqc(kind, batch, batch_size)
+
+    if timings_out:
+        if args["--fastqc"]:
+            for fastq, hash, timings in scheduler.timings:
+                write_timings(timings_out, dict(timings, type="fastqc", file=fastq, md5sum=hash))
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        write_timings(timings_out, {"type": "run",
+                                    "files": len(tasks),
+                                    "wall": time.time() - run_start,
+                                    "cpu": cpu_time() - run_cpu,
+                                    "children_cpu": children.ru_utime + children.ru_stime,
+                                    "peak_rss_mb": peak_rss_mb(),
+                                    "datastore": ds.calls})
+        timings_out.close()
 
     if error_fqs and len(fq_set) > 1:
         with indent(4):
             puts_err(colored.red("\nFastqs that errored:\n\n" +
                      '\n'.join(error_fqs) + "\n"))
 
-    if args["fetch"]:
-        print("]")
-
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,123 @@
+from fq.fastqc_table import pack_table
+from fq.sketch import heavy_hitters
+import re
+
+legacy_illumina_header = ["instrument",
+                          "flowcell_lane",
+                          "flowcell_number",
+                          None,  # x-tile
+                          None,  # y-tile
+                          "barcode",  # barcode - fetched later
+                          "pair"]
+
+illumina_header = ["instrument",
+                   "run_id",
+                   "flowcell_id",
+                   "flowcell_lane",
+                   None,  # tile number
+                   None,  # x-tile
+                   None,  # y-tile
+                   "pair",
+                   "filtered",
+                   "control_bits",
+                   "barcode"]  # barcode/index sequence; fetched later.
+
+# Separators between header fields.
+header_split = re.compile(r'(\:|#|/| )')
+
+# Illumina headers with a comment that is not pair:filtered:control:barcode.
+illumina_fields = re.compile(r'@[^:]*:[^:]*:[^:]*:([^:]*):([^:]*):[^:]*:[^: ]*(?: (?:[^:]*:){3}(\S*))?')
+
+# Number of barcodes tracked by the barcode summary.
+BARCODE_TOP = 256
+
+# Columns of the tables stored as <table>_data, read with fastqc-dump.
+header_tables = {'barcode_counts': ["barcode", "count"],
+                 'tile_counts': ["lane", "tile", "count"]}
+
+
+def _number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return s
+
+
+class header_stats:
+    """
+        Per lane/tile read counts and a bounded summary of the most
+        frequent barcodes, parsed from the header of every read.
+
+        Headers are split on ':' and recognised by their number of
+        fields; anything else falls back to a precompiled regex.
+    """
+
+    def __init__(self, barcodes=BARCODE_TOP):
+        self.parsed = 0
+        self.tiles = {}
+        self.barcodes = heavy_hitters(barcodes)
+
+    def update(self, headers):
+        tiles = self.tiles
+        barcodes = {}
+        parsed = 0
+        for h in headers:
+            f = h.split(":")
+            if len(f) == 10:
+                # @instrument:run:flowcell:lane:tile:x:y pair:filtered:control:barcode
+                key, barcode = (f[3], f[4]), f[9].partition(" ")[0]
+            elif len(f) == 5:
+                # @instrument:lane:tile:x:y#barcode/pair
+                key = (f[1], f[2])
+                barcode = f[4].partition("#")[2].partition("/")[0]
+            else:
+                m = illumina_fields.match(h)
+                if m is None:
+                    continue
+                key, barcode = m.group(1, 2), m.group(3)
+            parsed += 1
+            tiles[key] = tiles.get(key, 0) + 1
+            if barcode:
+                barcodes[barcode] = barcodes.get(barcode, 0) + 1
+        self.parsed += parsed
+        self.barcodes.update(barcodes)
+
+    def merge(self, other):
+        self.parsed += other.parsed
+        for key, n in other.tiles.iteritems():
+            self.tiles[key] = self.tiles.get(key, 0) + n
+        self.barcodes.merge(other.barcodes)
+
+    def scale(self, factor):
+        """
+            Scale counts of a sample up to the whole file.
+        """
+        self.parsed = int(round(self.parsed * factor))
+        self.tiles = dict((key, int(round(n * factor)))
+                          for key, n in self.tiles.iteritems())
+        self.barcodes.counts = dict((barcode, int(round(n * factor)))
+                                    for barcode, n in self.barcodes.counts.iteritems())
+        self.barcodes.error = int(round(self.barcodes.error * factor))
+
+    def result(self):
+        """
+            Return the most common barcode, the share of reads
+            carrying it and packed barcode and lane/tile tables.
+        """
+        d = {}
+        if not self.parsed:
+            return d
+        d["tile_counts_data"] = pack_table(
+            header_tables["tile_counts"],
+            sorted((_number(lane), _number(tile), n)
+                   for (lane, tile), n in self.tiles.iteritems()))
+        if self.barcodes.counts:
+            barcode, count = self.barcodes.most_common()
+            d["barcode"] = barcode
+            d["barcode_percent"] = count * 100.0 / self.parsed
+            d["barcode_counts_data"] = pack_table(
+                header_tables["barcode_counts"],
+                sorted(self.barcodes.counts.iteritems(),
+                       key=lambda x: (-x[1], x[0])))
+            d["barcode_counts_error"] = self.barcodes.error
+        return d
@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from copy import deepcopy
+from gcloud import datastore
+
+ops = {'=': lambda a, b: a == b,
+       '<': lambda a, b: a < b,
+       '>': lambda a, b: a > b,
+       '<=': lambda a, b: a <= b,
+       '>=': lambda a, b: a >= b,
+       '!=': lambda a, b: a != b}
+
+
+class memory_query:
+    def __init__(self, client, kind, projection=()):
+        self.client = client
+        self.kind = kind
+        self.projection = projection
+        self.filters = []
+
+    def add_filter(self, property_name, operator, value):
+        self.filters.append((property_name, operator, value))
+
+    def fetch(self, limit=None, start_cursor=None):
+        results = []
+        for (kind, name), item in sorted(self.client.entities.items()):
+            if kind != self.kind:
+                continue
+            if not all(var in item and ops[op](item[var], val)
+                       for var, op, val in self.filters):
+                continue
+            if not all(var in item for var in self.projection):
+                continue
+            entity = self.client._copy(item)
+            if self.projection:
+                for var in entity.keys():
+                    if var not in self.projection:
+                        del entity[var]
+            results.append(entity)
+        return memory_iterator(results, limit, start_cursor or 0,
+                               self.client.max_batch)
+
+
+class memory_iterator:
+    def __init__(self, results, limit, offset, max_batch=None):
+        self.results = results
+        self.limit = limit
+        self.offset = offset
+        self.max_batch = max_batch
+
+    def __iter__(self):
+        # Iteration continues across batches, up to the limit.
+        end = None if self.limit is None else self.offset + self.limit
+        return iter(self.results[self.offset:end])
+
+    def next_page(self):
+        """
+            Return a page, whether the batch ended early, and the
+            cursor, as gcloud does: more results are only reported
+            for batches cut at max_batch (NOT_FINISHED), not for
+            those that reached the limit.
+        """
+        end = len(self.results)
+        if self.limit is not None:
+            end = min(end, self.offset + self.limit)
+        more_results = False
+        if self.max_batch is not None and end - self.offset > self.max_batch:
+            end = self.offset + self.max_batch
+            more_results = True
+        return self.results[self.offset:end], more_results, end
+
+
+class memory_client:
+    """
+        In-memory stand-in for gcloud.datastore.Client supporting the
+        calls fq makes. The first `defer` keys of every get_multi call
+        are deferred once, to exercise retries, and query batches end
+        after `max_batch` results, as Datastore batches may.
+    """
+
+    def __init__(self, project="memory", defer=0, max_batch=None):
+        self.project = project
+        self.defer = defer
+        self.max_batch = max_batch
+        self.deferred = set()
+        self.entities = {}
+        self.calls = {}
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _copy(self, item):
+        # Entity only accepts a tuple or list of excluded names.
+        entity = datastore.Entity(key=item.key,
+                                  exclude_from_indexes=list(item.exclude_from_indexes))
+        entity.update(deepcopy(dict(item)))
+        return entity
+
+    def key(self, kind, name):
+        return datastore.Key(kind, name, project=self.project)
+
+    def get(self, key):
+        self._call("get")
+        item = self.entities.get((key.kind, key.name))
+        if item is not None:
+            return self._copy(item)
+
+    def get_multi(self, keys, missing=None, deferred=None):
+        self._call("get_multi")
+        found = []
+        for n, key in enumerate(keys):
+            path = (key.kind, key.name)
+            if n < self.defer and deferred is not None and path not in self.deferred:
+                self.deferred.add(path)
+                deferred.append(key)
+            elif path in self.entities:
+                found.append(self._copy(self.entities[path]))
+            elif missing is not None:
+                missing.append(datastore.Entity(key=key))
+        return found
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        self._call("put_multi")
+        for entity in entities:
+            self.entities[(entity.key.kind, entity.key.name)] = self._copy(entity)
+
+    @contextmanager
+    def transaction(self):
+        # Calls are not interleaved in memory, so nothing conflicts.
+        self._call("transaction")
+        yield
+
+    def query(self, kind=None, projection=()):
+        return memory_query(self, kind, projection)
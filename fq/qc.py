@@ -0,0 +1,190 @@
+from fq import fastqc_headers
+from fq.fastqc_table import pack_table
+
+def _percentile(hist, total, p):
+    # Smallest value with at least p of the observations at or below it.
+    target = p * total
+    seen = 0
+    for value in sorted(hist):
+        seen += hist[value]
+        if seen >= target:
+            return value
+
+
+def _status(value, warn, fail):
+    if value >= fail:
+        return "fail"
+    elif value >= warn:
+        return "warn"
+    return "pass"
+
+
+def _worst(*statuses):
+    return max(statuses, key=["pass", "warn", "fail"].index)
+
+
+class qc_stats:
+    """
+        Streaming accumulator for FastQC-equivalent module tables.
+
+        Every block is summarised column by column: reads are padded
+        to the longest read and joined, so that the bases and qualities
+        at a position are one strided slice of the joined string, and
+        are counted with str.count for each character seen so far.
+        The per-read work done in Python is limited to GC and mean
+        quality.
+    """
+
+    def __init__(self):
+        self.total_reads = 0
+        # Per position histograms of raw quality characters.
+        self.base_quality = []
+        # Per position counts of G, A, T, C and N.
+        self.base_content = []
+        self.sequence_quality = {}
+        self.sequence_gc = {}
+        self.lengths = {}
+        # Quality characters seen so far.
+        self.quality_chars = ""
+
+    def update(self, seqs, quals):
+        if not seqs:
+            return
+        self.total_reads += len(seqs)
+        sequence_quality = self.sequence_quality
+        sequence_gc = self.sequence_gc
+        lengths = self.lengths
+        width = 0
+        for seq, qual in zip(seqs, quals):
+            n = len(seq)
+            lengths[n] = lengths.get(n, 0) + 1
+            if n == 0:
+                continue
+            if n > width:
+                width = n
+            q = sum(bytearray(qual)) // n
+            sequence_quality[q] = sequence_quality.get(q, 0) + 1
+            gc = int(round((seq.count("G") + seq.count("C")) * 100.0 / n))
+            sequence_gc[gc] = sequence_gc.get(gc, 0) + 1
+        if not width:
+            return
+        while len(self.base_quality) < width:
+            self.base_quality.append({})
+            self.base_content.append([0] * 5)
+        # Padding is NUL, which is neither a base nor a quality.
+        joined_seqs = "".join([seq.ljust(width, "\0") for seq in seqs])
+        joined_quals = "".join([qual.ljust(width, "\0") for qual in quals])
+        new_chars = joined_quals.translate(None, self.quality_chars + "\0")
+        if new_chars:
+            self.quality_chars += "".join(sorted(set(new_chars)))
+        quality_chars = self.quality_chars
+        for pos in xrange(width):
+            col = joined_quals[pos::width]
+            hist = self.base_quality[pos]
+            for c in quality_chars:
+                n = col.count(c)
+                if n:
+                    hist[c] = hist.get(c, 0) + n
+            col = joined_seqs[pos::width]
+            counts = self.base_content[pos]
+            for i, base in enumerate("GATCN"):
+                counts[i] += col.count(base)
+
+    def merge(self, other):
+        self.total_reads += other.total_reads
+        for pos, hist in enumerate(other.base_quality):
+            if pos == len(self.base_quality):
+                self.base_quality.append({})
+                self.base_content.append([0] * 5)
+            merged = self.base_quality[pos]
+            for c, n in hist.iteritems():
+                merged[c] = merged.get(c, 0) + n
+            self.base_content[pos] = map(sum, zip(self.base_content[pos],
+                                                  other.base_content[pos]))
+        for name in ("sequence_quality", "sequence_gc", "lengths"):
+            merged = getattr(self, name)
+            for k, n in getattr(other, name).iteritems():
+                merged[k] = merged.get(k, 0) + n
+        self.quality_chars += "".join(c for c in other.quality_chars
+                                      if c not in self.quality_chars)
+
+    def scale(self, factor):
+        """
+            Scale the read counts of a sample up to the whole file.
+            Per position tables are proportions, and are unchanged.
+        """
+        self.total_reads = int(round(self.total_reads * factor))
+        for name in ("sequence_quality", "sequence_gc", "lengths"):
+            setattr(self, name, dict((k, int(round(n * factor)))
+                                     for k, n in getattr(self, name).iteritems()))
+
+    def encoding(self):
+        """
+            Return the phred offset and FastQC's name for it,
+            judged from the lowest quality character seen.
+        """
+        lowest = min(min(hist) for hist in self.base_quality if hist)
+        if ord(lowest) < 64:
+            return 33, "Sanger / Illumina 1.9"
+        return 64, "Illumina 1.5"
+
+    def result(self):
+        """
+            Return fastqc_* fields: a packed table and a
+            pass/warn/fail status for every module.
+        """
+        d = {}
+        if not self.base_quality:
+            return d
+        offset, d["fastqc_encoding"] = self.encoding()
+
+        rows = []
+        for pos, hist in enumerate(self.base_quality):
+            hist = dict((ord(c) - offset, n) for c, n in hist.iteritems())
+            total = sum(hist.values())
+            mean = sum(q * n for q, n in hist.iteritems()) / float(total)
+            rows.append([pos + 1, mean] + [_percentile(hist, total, p)
+                                           for p in (0.5, 0.25, 0.75, 0.1, 0.9)])
+        # Low values are worse, so the thresholds are negated.
+        d["per_base_sequence_quality"] = _worst(
+            _status(-min(row[3] for row in rows), -10, -5),
+            _status(-min(row[2] for row in rows), -25, -20))
+        d["fastqc_per_base_sequence_quality_data"] = pack_table(
+            fastqc_headers["per_base_sequence_quality"], rows)
+
+        rows = sorted((q - offset, n) for q, n in self.sequence_quality.iteritems())
+        if rows:
+            mode = max(rows, key=lambda x: x[1])[0]
+            d["per_sequence_quality_scores"] = _status(-mode, -27, -20)
+        d["fastqc_per_sequence_quality_scores_data"] = pack_table(
+            fastqc_headers["per_sequence_quality_scores"], rows)
+
+        rows = []
+        n_rows = []
+        for pos, (G, A, T, C, N) in enumerate(self.base_content):
+            called = float(G + A + T + C) or 1.0
+            rows.append([pos + 1] + [x * 100 / called for x in (G, A, T, C)])
+            n_rows.append([pos + 1, N * 100.0 / (called + N)])
+        content_diff = max(max(abs(row[1] - row[4]), abs(row[2] - row[3]))
+                           for row in rows)
+        d["per_base_sequence_content"] = _status(content_diff, 10, 20)
+        d["fastqc_per_base_sequence_content_data"] = pack_table(
+            fastqc_headers["per_base_sequence_content"], rows)
+        d["per_base_n_content"] = _status(max(row[1] for row in n_rows), 5, 20)
+        d["fastqc_per_base_n_content_data"] = pack_table(
+            fastqc_headers["per_base_n_content"], n_rows)
+
+        d["fastqc_per_sequence_gc_content_data"] = pack_table(
+            fastqc_headers["per_sequence_gc_content"],
+            [[gc, self.sequence_gc.get(gc, 0)] for gc in range(101)])
+
+        rows = sorted(self.lengths.iteritems())
+        if 0 in self.lengths:
+            d["sequence_length_distribution"] = "fail"
+        elif len(rows) > 1:
+            d["sequence_length_distribution"] = "warn"
+        else:
+            d["sequence_length_distribution"] = "pass"
+        d["fastqc_sequence_length_distribution_data"] = pack_table(
+            fastqc_headers["sequence_length_distribution"], rows)
+        return d
@@ -0,0 +1,65 @@
+# Finding fastqs in directory trees (fq scan).
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import stat
+
+# Fastq file names, uncompressed or compressed.
+fastq_name = re.compile(r"\.(?:fastq|fq)(?:\.(?:gz|bgz|bz2|xz|zst))?$")
+
+
+def scan_dir(dirname):
+    """
+        List a directory, returning its subdirectories and the
+        (path, stat) of the fastqs in it. Symlinked fastqs are
+        resolved; symlinked directories are not followed.
+    """
+    dirs, files = [], []
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return dirs, files
+    for name in names:
+        path = os.path.join(dirname, name)
+        try:
+            st = os.lstat(path)
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(path)
+                continue
+            if not fastq_name.search(name):
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                path = os.path.realpath(path)
+                st = os.stat(path)
+        except OSError:
+            # Removed while scanning, or a broken link.
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append((path, st))
+    return dirs, files
+
+
+def walk_fastqs(roots, threads=16):
+    """
+        Yield the (path, stat) of every fastq under `roots`
+        (directories or files), listing `threads` directories
+        at a time. Paths are real paths.
+    """
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for root in roots:
+            root = os.path.realpath(root)
+            if os.path.isdir(root):
+                pending.append(pool.apply_async(scan_dir, (root,)))
+            elif os.path.isfile(root):
+                yield root, os.stat(root)
+        while pending:
+            dirs, files = pending.popleft().get()
+            for dirname in dirs:
+                pending.append(pool.apply_async(scan_dir, (dirname,)))
+            for x in files:
+                yield x
+    finally:
+        pool.terminate()
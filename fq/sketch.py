@@ -0,0 +1,144 @@
+from math import sqrt
+
+# Approximate memory used by a dict entry holding a short string key.
+ENTRY_OVERHEAD = 120
+
+
+def _mix(h):
+    # Python 2 string hashes have poorly distributed low bits.
+    h = (h ^ (h >> 33)) * 0xff51afd7ed558ccd & 0xffffffffffffffff
+    return h ^ (h >> 33)
+
+
+class distinct_sample:
+    """
+        Cardinality estimator based on distinct sampling.
+
+        Items are kept (with exact counts) only if their hash falls
+        within a sampling level that is raised each time the sample
+        exceeds capacity. Scaling the sample by 2 ** level estimates the
+        number of distinct items and of items seen exactly once.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1)
+        self.level = 0
+        self.mask = 0
+        self.counts = {}
+
+    def update(self, counts):
+        mask = self.mask
+        sample = self.counts
+        get = sample.get
+        for item, n in counts.iteritems():
+            if not mask or _mix(hash(item)) & mask == 0:
+                sample[item] = get(item, 0) + n
+        while len(sample) > self.capacity:
+            self.level += 1
+            self.mask = (1 << self.level) - 1
+            mask = self.mask
+            for item in sample.keys():
+                if _mix(hash(item)) & mask:
+                    del sample[item]
+
+    def merge(self, other):
+        """
+            Add the items of a sample taken from another part
+            of the same data.
+        """
+        if other.level > self.level:
+            self.level = other.level
+            self.mask = other.mask
+            for item in self.counts.keys():
+                if _mix(hash(item)) & self.mask:
+                    del self.counts[item]
+        self.update(other.counts)
+
+    def estimate(self, singletons=False):
+        """
+            Return (estimate, error) where error is the half width
+            of an approximate 95% confidence interval.
+        """
+        if singletons:
+            n = sum(1 for v in self.counts.itervalues() if v == 1)
+        else:
+            n = len(self.counts)
+        scale = 1 << self.level
+        p = 1.0 / scale
+        error = 1.96 * sqrt(n * (1 - p)) * scale
+        return n * scale, error
+
+
+class heavy_hitters:
+    """
+        Mergeable Misra-Gries summary of the most frequent items.
+
+        Counts are lower bounds and are off by at most `error`.
+    """
+
+    def __init__(self, k):
+        self.k = max(k, 1)
+        self.counts = {}
+        self.error = 0
+
+    def update(self, counts):
+        summary = self.counts
+        get = summary.get
+        for item, n in counts.iteritems():
+            summary[item] = get(item, 0) + n
+        if len(summary) > self.k:
+            # Subtract the (k + 1)th largest count from every counter.
+            cut = sorted(summary.itervalues(), reverse=True)[self.k]
+            self.error += cut
+            self.counts = dict((item, n - cut)
+                               for item, n in summary.iteritems()
+                               if n > cut)
+
+    def merge(self, other):
+        self.error += other.error
+        self.update(other.counts)
+
+    def most_common(self):
+        if not self.counts:
+            return None, 0
+        return max(self.counts.iteritems(), key=lambda x: x[1])
+
+
+class duplicate_sketch:
+    """
+        Bounded-memory replacement for exact per-sequence counts.
+
+        The memory budget (in bytes) is split between a distinct sample
+        and a heavy hitters summary, sized from the read length of the
+        first batch.
+    """
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.sample = None
+        self.hitters = None
+
+    def _allocate(self, counts):
+        # Size both summaries from the memory budget of this sketch.
+        length = sum(map(len, counts)) / max(len(counts), 1)
+        entries = self.memory // (2 * (ENTRY_OVERHEAD + length))
+        self.sample = distinct_sample(entries)
+        self.hitters = heavy_hitters(entries)
+
+    def update(self, counts):
+        if self.sample is None:
+            self._allocate(counts)
+        self.sample.update(counts)
+        self.hitters.update(counts)
+
+    def merge(self, other):
+        """
+            Add a sketch of another part of the same data, which
+            may have been given a smaller share of the memory.
+        """
+        if other.sample is None:
+            return
+        if self.sample is None:
+            self._allocate(other.sample.counts)
+        self.sample.merge(other.sample)
+        self.hitters.merge(other.hitters)
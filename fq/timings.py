@@ -0,0 +1,125 @@
+# Resource use of profiling phases and Datastore calls (--timings).
+from collections import OrderedDict
+from contextlib import contextmanager
+import resource
+import sys
+import time
+import types
+
+# ru_maxrss is in bytes on OS X, KB elsewhere.
+RSS_UNIT = 1024.0 * 1024 if sys.platform == "darwin" else 1024.0
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RSS_UNIT
+
+
+def bytes_read():
+    # Bytes read by this process so far (Linux only; None elsewhere).
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+class phase_timings:
+    """
+        Wall time, CPU time, bytes read and peak RSS of the phases
+        of profiling a fastq. Repeated phases are added up. Peak RSS
+        is that of the process at the end of the phase.
+    """
+
+    def __init__(self, phases=None):
+        self.phases = OrderedDict(phases or ())
+
+    @contextmanager
+    def phase(self, name, nbytes=None):
+        """
+            Time a phase. Bytes read are measured by the OS unless
+            given; files read through a memory map need `nbytes`.
+        """
+        wall, cpu, read = time.time(), cpu_time(), bytes_read()
+        try:
+            yield
+        finally:
+            if nbytes is None and read is not None:
+                nbytes = bytes_read() - read
+            d = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "bytes": 0})
+            d["wall"] += time.time() - wall
+            d["cpu"] += cpu_time() - cpu
+            d["bytes"] += nbytes or 0
+            d["peak_rss_mb"] = peak_rss_mb()
+
+    def copy(self):
+        return phase_timings((k, dict(v)) for k, v in self.phases.items())
+
+    def result(self):
+        return self.phases
+
+
+class datastore_calls:
+    """
+        Backend wrapper counting the calls to, and time spent in,
+        each Datastore method. Time spent iterating over query
+        results is added to the query.
+    """
+    counted = ("get", "get_multi", "put_multi", "query", "query_pages")
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = {}
+
+    def _add(self, name, calls, seconds):
+        d = self.calls.setdefault(name, {"calls": 0, "seconds": 0.0})
+        d["calls"] += calls
+        d["seconds"] += seconds
+
+    def _iterate(self, name, results):
+        while True:
+            start = time.time()
+            try:
+                item = next(results)
+            except StopIteration:
+                self._add(name, 0, time.time() - start)
+                return
+            self._add(name, 0, time.time() - start)
+            yield item
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name not in self.counted:
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                self._add(name, 1, time.time() - start)
+            if isinstance(result, types.GeneratorType):
+                return self._iterate(name, result)
+            return result
+        return call
+
+    def snapshot(self):
+        return dict((k, dict(v)) for k, v in self.calls.items())
+
+    def since(self, snapshot):
+        """
+            Return the calls made since a snapshot.
+        """
+        d = {}
+        for name, v in self.calls.items():
+            before = snapshot.get(name, {"calls": 0, "seconds": 0.0})
+            if v["calls"] > before["calls"] or v["seconds"] > before["seconds"]:
+                d[name] = {"calls": v["calls"] - before["calls"],
+                           "seconds": v["seconds"] - before["seconds"]}
+        return d
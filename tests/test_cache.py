@@ -0,0 +1,95 @@
+"""
+Cached queries: results are written and read back a page at
+a time, and reads continue from the backend if evicted.
+
+    python -m unittest discover tests
+"""
+from docopt import docopt
+from fq import fqprofile
+from fq.backend import sqlite_backend
+from fq.cache import entity_cache
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class test_cached_queries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="fq_test")
+        fqprofile.cache = None
+        fqprofile.ds = sqlite_backend(os.path.join(self.tmp, "test.db"))
+        self.names = ["fq%02d" % i for i in range(25)]
+        fqprofile.update_items("fastq", [(name, {"bases": 1}) for name in self.names])
+        fqprofile.cache = self.cache()
+
+    def tearDown(self):
+        fqprofile.cache = None
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def cache(self, max_size=1 << 20):
+        return entity_cache(os.path.join(self.tmp, "cache.db"), "test", max_size=max_size)
+
+    def pages(self):
+        return fqprofile.cache._connect().execute("SELECT COUNT(*) FROM page").fetchone()[0]
+
+    def names_of(self, pages):
+        return [x.key.name for page in pages for x in page]
+
+    def test_pages_are_cached_as_read(self):
+        pages = fqprofile.query_pages("fastq", page_size=10, cached=True)
+        for i in range(3):
+            next(pages)
+            self.assertEqual(self.pages(), i + 1)
+        self.assertRaises(StopIteration, next, pages)
+        cached = fqprofile.cache.get_pages("fastq")
+        self.assertEqual(map(len, cached), [10, 10, 5])
+        self.assertEqual(self.names_of(fqprofile.query_pages("fastq", page_size=4,
+                                                             cached=True)),
+                         self.names)
+
+    def test_query_item(self):
+        filters = [("bases", "=", 1)]
+        self.assertEqual([x.key.name for x in fqprofile.query_item("fastq", filters,
+                                                                   cached=True)],
+                         self.names)
+        self.assertIsNotNone(fqprofile.cache.get_pages("fastq", filters))
+
+    def test_evicted_while_read(self):
+        list(fqprofile.query_pages("fastq", page_size=10, cached=True))
+        pages = fqprofile.query_pages("fastq", page_size=10, cached=True)
+        first = next(pages)
+        fqprofile.cache.invalidate("fastq")
+        self.assertEqual(self.names_of([first] + list(pages)), self.names)
+
+    def test_large_results_are_not_cached(self):
+        fqprofile.cache = self.cache(max_size=1000)
+        results = fqprofile.query_pages("fastq", page_size=10, cached=True)
+        self.assertEqual(self.names_of(results), self.names)
+        self.assertIsNone(fqprofile.cache.get_pages("fastq"))
+        self.assertEqual(self.pages(), 0)
+
+    def test_unfinished_query_is_not_cached(self):
+        pages = fqprofile.query_pages("fastq", page_size=10, cached=True)
+        next(pages)
+        pages.close()
+        self.assertIsNone(fqprofile.cache.get_pages("fastq"))
+        self.assertEqual(self.pages(), 0)
+
+    def test_fetch_without_cache(self):
+        for argv in (["fetch", "--cache-ttl=0", "a.fq"],
+                     ["fastqc-dump", "--cache-ttl=0", "per_base_n_content", "a.fq"]):
+            self.assertEqual(docopt(fqprofile.__doc__, argv)["--cache-ttl"], "0")
+        fqprofile.get_items("fastq", ["fq00"], cached=True)
+        # Profiled again elsewhere, so not invalidated here.
+        m = fqprofile.get_item("fastq", "fq00")
+        m["bases"] = 2
+        fqprofile.ds.put_multi([m])
+        self.assertEqual(fqprofile.get_item("fastq", "fq00", cached=True)["bases"], 1)
+        fqprofile.cache = entity_cache(os.path.join(self.tmp, "cache.db"), "test", ttl=0)
+        self.assertEqual(fqprofile.get_item("fastq", "fq00", cached=True)["bases"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Decompression: truncated input is an error, whole input of
+concatenated streams is not, and missing modules are named.
+
+    python -m unittest discover tests
+"""
+from fq import compression
+from fq.compression import decompress_blocks, decompress_errors, missing_module
+from StringIO import StringIO
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+DATA = "".join("@r%d\nACGTACGTAC\n+\nFFFFFFFFFF\n" % i for i in range(20000))
+
+
+def _gzip(data):
+    f = StringIO()
+    with gzip.GzipFile(fileobj=f, mode="wb") as g:
+        g.write(data)
+    return f.getvalue()
+
+
+def _chunks(raw, size=4096):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+class test_decompress(unittest.TestCase):
+
+    def decompress(self, raw, **kwargs):
+        return "".join(decompress_blocks(_chunks(raw), **kwargs))
+
+    def test_whole_streams(self):
+        half = len(DATA) // 2
+        for raw in (_gzip(DATA),
+                    _gzip(DATA[:half]) + _gzip(DATA[half:]),
+                    bz2.compress(DATA),
+                    bz2.compress(DATA[:half]) + bz2.compress(DATA[half:])):
+            for prefetch in (True, False):
+                self.assertEqual(self.decompress(raw, prefetch=prefetch), DATA)
+
+    def test_truncated(self):
+        for raw in (_gzip(DATA), bz2.compress(DATA), _gzip(DATA) + _gzip(DATA)):
+            for end in (len(raw) // 3, len(raw) - 1):
+                self.assertRaises(decompress_errors, self.decompress, raw[:end])
+
+    def test_stretch(self):
+        # Stretches of a file may end within a stream.
+        raw = _gzip(DATA)
+        data = self.decompress(raw[:len(raw) // 2], complete=False)
+        self.assertTrue(data and DATA.startswith(data))
+
+
+class test_missing_module(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="fq_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_missing_module(self):
+        xz = os.path.join(self.tmp, "reads.fq.xz")
+        with open(xz, "wb") as f:
+            f.write("\xfd7zXZ\x00" + "\0" * 32)
+        gz = os.path.join(self.tmp, "reads.fq.gz")
+        with open(gz, "wb") as f:
+            f.write(_gzip(DATA))
+        self.assertEqual(missing_module(xz),
+                         None if compression.lzma else "backports.lzma")
+        self.assertEqual(missing_module(gz), None)
+        if compression.lzma is None:
+            # Not reported as corrupt input.
+            blocks = decompress_blocks(open(xz, "rb"))
+            self.assertRaises(ImportError, next, blocks)
+            self.assertFalse(issubclass(ImportError, decompress_errors))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Sampling: total_reads estimated from a sample of compressed
+fastqs is close to the known number of reads.
+
+    python -m unittest discover tests
+"""
+from binascii import unhexlify
+from fq.compression import decompress_blocks
+from fq.fastqc_table import fastqc_table
+from fq.fq_util import sample_fastq
+import gzip
+import os
+import random
+import shutil
+import string
+import struct
+import tempfile
+import unittest
+import zlib
+
+READS = 200000
+
+_bases = string.maketrans("".join(map(chr, range(256))), "ACGT" * 64)
+_quals = string.maketrans("".join(map(chr, range(256))), "FGHI#:,F" * 32)
+
+
+def _fastq(n, length=100):
+    size = n * length
+    seqs = unhexlify("%0*x" % (2 * size, random.Random(1).getrandbits(8 * size)))
+    seqs = seqs.translate(_bases)
+    quals = seqs[::-1].translate(_quals)
+    return "".join("@r%d\n%s\n+\n%s\n" % (i, seqs[i * length:(i + 1) * length],
+                                          quals[i * length:(i + 1) * length])
+                   for i in xrange(n))
+
+
+def _bgzf_block(data):
+    c = zlib.compressobj(1, zlib.DEFLATED, -15)
+    compressed = c.compress(data) + c.flush()
+    return ("\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0" +
+            struct.pack("<H", len(compressed) + 25) + compressed +
+            struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class test_sample(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix="fq_test")
+        data = _fastq(READS)
+        cls.gzip = os.path.join(cls.tmp, "reads.fq.gz")
+        with gzip.open(cls.gzip, "wb", compresslevel=1) as f:
+            f.write(data)
+        cls.bgzf = os.path.join(cls.tmp, "reads.bgz.fq.gz")
+        with open(cls.bgzf, "wb") as f:
+            for i in xrange(0, len(data), 65280):
+                f.write(_bgzf_block(data[i:i + 65280]))
+            f.write(_bgzf_block(""))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def check(self, filename, method):
+        d = sample_fastq(filename, method, n=10000)
+        self.assertEqual(d["sample_reads"], 10000)
+        # The compression ratio varies along the file, beyond
+        # the error reported for the size of records.
+        self.assertTrue(abs(d["total_reads"] - READS) <= READS * 0.02,
+                        "%s: %d reads" % (method, d["total_reads"]))
+
+    def test_gzip_head(self):
+        self.check(self.gzip, "head")
+
+    def test_bgzf_head(self):
+        self.check(self.bgzf, "head")
+
+    def test_bgzf_seek(self):
+        self.check(self.bgzf, "seek")
+
+    def test_sample_duplication(self):
+        # Duplication is that of the sample; counts are scaled.
+        d = sample_fastq(self.gzip, "head", n=10000, qc=True)
+        self.assertNotIn("unique_reads", d)
+        self.assertEqual(d["sample_unique_reads"], 10000)
+        self.assertEqual(d["sample_percent_unique"], 100.0)
+        lengths = fastqc_table(d["fastqc_sequence_length_distribution_data"])
+        self.assertEqual(list(lengths.rows()), [(100, d["total_reads"])])
+
+    def test_no_prefetch(self):
+        # Raw blocks are only read as decompressed blocks are used.
+        read = []
+
+        def chunks():
+            with open(self.gzip, "rb") as f:
+                for raw in iter(lambda: f.read(1 << 20), ""):
+                    read.append(raw)
+                    yield raw
+        blocks = decompress_blocks(chunks(), prefetch=False)
+        for i in range(3):
+            next(blocks)
+            self.assertEqual(len(read), i + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
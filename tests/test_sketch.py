@@ -0,0 +1,66 @@
+"""
+Duplicate sketches: parts profiled with a share of the memory
+merge into a sketch sized from the whole budget.
+
+    python -m unittest discover tests
+"""
+from fq.sketch import duplicate_sketch
+import random
+import unittest
+
+
+def _reads(n, seed=1):
+    rng = random.Random(seed)
+    reads = []
+    for i in range(n):
+        if reads and rng.random() < 0.2:
+            reads.append(rng.choice(reads))
+        else:
+            reads.append("".join(rng.choice("ACGT") for j in range(50)))
+    return reads
+
+
+def _counts(reads):
+    counts = {}
+    for read in reads:
+        counts[read] = counts.get(read, 0) + 1
+    return counts
+
+
+class test_duplicate_sketch(unittest.TestCase):
+
+    def sketch(self, reads, memory, parts=1):
+        merged = duplicate_sketch(memory)
+        size = len(reads) // parts
+        for i in range(parts):
+            part = duplicate_sketch(memory // parts)
+            part.update(_counts(reads[i * size:(i + 1) * size]))
+            merged.merge(part)
+        return merged
+
+    def test_merge_uses_own_memory(self):
+        reads = _reads(20000)
+        counts = _counts(reads)
+        single = duplicate_sketch(16 << 20)
+        single.update(counts)
+        merged = self.sketch(reads, 16 << 20, parts=4)
+        self.assertEqual(merged.sample.capacity, single.sample.capacity)
+        # Within memory, both are exact.
+        singletons = sum(1 for n in counts.itervalues() if n == 1)
+        self.assertEqual(single.sample.estimate(singletons=True), (singletons, 0))
+        self.assertEqual(merged.sample.estimate(singletons=True), (singletons, 0))
+
+    def test_merge_beyond_memory(self):
+        # Parts sampled at a higher level than a single pass would
+        # be are merged at that level, within the error given.
+        reads = _reads(20000)
+        counts = _counts(reads)
+        merged = self.sketch(reads, 256 << 10, parts=4)
+        self.assertTrue(merged.sample.level > 0)
+        self.assertTrue(len(merged.sample.counts) <= merged.sample.capacity)
+        estimate, error = merged.sample.estimate()
+        self.assertTrue(abs(estimate - len(counts)) <= error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+"""
+Batched storage: get_items/update_items batching, retries of
+deferred keys and transient errors, and merge semantics.
+
+    python -m unittest discover tests
+"""
+from datetime import datetime
+from fq import fqprofile
+from fq.backend import datastore_backend, sqlite_backend
+from fq.timings import datastore_calls
+from multiprocessing import Pool
+from StringIO import StringIO
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from fq.memory_client import memory_client
+except ImportError:
+    memory_client = None
+
+
+def _update_sqlite(task):
+    # Update fastqs from another process, with its own connection.
+    db, names = task
+    fqprofile.BACKOFF = 0
+    fqprofile.cache = None
+    fqprofile.ds = sqlite_backend(db)
+    for name in names:
+        fqprofile.update_items("fastq", [(name, {"bases": 1})])
+
+
+class storage_test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="fq_test")
+        self.backoff = fqprofile.BACKOFF
+        fqprofile.BACKOFF = 0
+        fqprofile.cache = None
+        fqprofile.messages = []
+        fqprofile.ds = datastore_calls(self.backend())
+
+    def tearDown(self):
+        fqprofile.BACKOFF = self.backoff
+        fqprofile.messages = None
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def backend(self):
+        return sqlite_backend(os.path.join(self.tmp, "test.db"))
+
+    def calls(self, name):
+        return fqprofile.ds.calls.get(name, {}).get("calls", 0)
+
+
+class test_sqlite_storage(storage_test):
+
+    def test_get_items_batches(self):
+        names = ["fq%02d" % i for i in range(25)]
+        fqprofile.update_items("fastq", [(name, {"bases": 1}) for name in names],
+                               batch_size=10)
+        fqprofile.ds.calls = {}
+        found = fqprofile.get_items("fastq", names + ["missing"], batch_size=10)
+        self.assertEqual(sorted(found), names)
+        self.assertEqual(self.calls("get_multi"), 3)
+
+    def test_update_items_batches(self):
+        updates = [("fq%02d" % i, {"bases": 1}) for i in range(25)]
+        fqprofile.update_items("fastq", updates, batch_size=10)
+        # One put of fastqs and one of aggregates per batch.
+        self.assertEqual(self.calls("put_multi"), 6)
+        summary = fqprofile.get_item("fastq_summary", "all")
+        self.assertEqual(summary["count"], 25)
+        self.assertEqual(summary["bases"], 25)
+
+    def test_merge(self):
+        fqprofile.update_items("fastq", [("a", {"error": ["x"],
+                                                "date_created": datetime(2016, 2, 1),
+                                                "bases": 10})])
+        fqprofile.update_items("fastq", [("a", {"error": ["y", "x"],
+                                                "date_created": datetime(2016, 1, 1),
+                                                "bases": 12})])
+        fqprofile.update_items("fastq", [("a", {"date_created": datetime(2016, 3, 1)})])
+        item = fqprofile.get_item("fastq", "a")
+        self.assertEqual(sorted(item["error"]), ["x", "y"])
+        self.assertEqual(item["date_created"], datetime(2016, 1, 1))
+        self.assertEqual(item["bases"], 12)
+        self.assertEqual(item["fq_profile_count"], 3)
+        # The aggregate counts the fastq once, with its latest bases.
+        summary = fqprofile.get_item("fastq_summary", "all")
+        self.assertEqual((summary["count"], summary["bases"]), (1, 12))
+
+    def test_fastqc_is_not_counted(self):
+        fqprofile.ck = fqprofile.checksums(os.path.join(self.tmp, "checksum.db"), "test")
+        fqprofile.update_items("fastq", [("a", {"bases": 1})])
+        fqprofile.store_fastqc("fastq", [("a.fq", "a", {"basic_statistics": "pass"})], 10)
+        item = fqprofile.get_item("fastq", "a")
+        self.assertEqual(item["basic_statistics"], "pass")
+        self.assertEqual(item["fq_profile_count"], 1)
+
+    def test_merge_same_name_in_batch(self):
+        fqprofile.update_items("fastq", [("a", {"error": ["x"], "bases": 1}),
+                                         ("a", {"error": ["y"], "bases": 2})])
+        item = fqprofile.get_item("fastq", "a")
+        self.assertEqual(sorted(item["error"]), ["x", "y"])
+        self.assertEqual(item["fq_profile_count"], 2)
+        summary = fqprofile.get_item("fastq_summary", "all")
+        self.assertEqual((summary["count"], summary["bases"]), (1, 2))
+
+    def dump(self):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            fqprofile.dump_items(fqprofile.query_pages("fastq"), "ndjson")
+            return map(json.loads, sys.stdout.getvalue().splitlines())
+        finally:
+            sys.stdout = stdout
+
+    def test_dump_fields(self):
+        fqprofile.update_items("fastq", [("a", {"sample_most_abundant_sequence": "ACGT",
+                                                "fastqc_error": ["failed"]})])
+        item, = self.dump()
+        self.assertEqual(item["sample_most_abundant_sequence"], "ACGT")
+        self.assertNotIn("fastqc_error", item)
+
+    def test_dump_timings(self):
+        timings = json.dumps({"phases": {"scan": {"wall": 1.0}}})
+        fqprofile.update_items("fastq", [("a", {"profile_timings": timings})])
+        self.assertIn("profile_timings", fqprofile.get_item("fastq", "a").exclude_from_indexes)
+        item, = self.dump()
+        self.assertEqual(json.loads(item["profile_timings"]), json.loads(timings))
+
+    def test_header_tables(self):
+        from fq.headers import header_stats, header_tables
+        headers = header_stats()
+        headers.update(["@M:1:FC:1:1101:1:1 1:N:0:ACGT",
+                        "@M:1:FC:1:1101:1:2 1:N:0:ACGT",
+                        "@M:1:FC:2:1102:1:1 1:N:0:TTTT"])
+        fqprofile.update_items("fastq", [("a", headers.result())])
+        item = fqprofile.get_item("fastq", "a")
+        self.assertEqual(list(fqprofile.fastqc_rows(item, "tile_counts_data",
+                                                    header_tables["tile_counts"])),
+                         ["1\t1101\t2", "2\t1102\t1"])
+        self.assertEqual(list(fqprofile.fastqc_rows(item, "barcode_counts_data",
+                                                    header_tables["barcode_counts"])),
+                         ["ACGT\t2", "TTTT\t1"])
+
+    def test_concurrent_aggregates(self):
+        db = os.path.join(self.tmp, "test.db")
+        tasks = [(db, ["p%d_%02d" % (p, i) for i in range(20)]) for p in range(4)]
+        pool = Pool(4)
+        pool.map(_update_sqlite, tasks)
+        pool.close()
+        pool.join()
+        summary = fqprofile.get_item("fastq_summary", "all")
+        self.assertEqual((summary["count"], summary["bases"]), (80, 80))
+
+    def test_errors_are_not_retried(self):
+        # SQLite has no transient errors; failures are raised at once.
+        calls = []
+
+        def fail():
+            calls.append(1)
+            raise ValueError("failed")
+        self.assertRaises(ValueError, fqprofile.retry, fail)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(fqprofile.messages, [])
+
+
+@unittest.skipIf(memory_client is None, "gcloud is not installed")
+class test_datastore_storage(storage_test):
+
+    def backend(self):
+        self.client = memory_client(defer=3)
+        return datastore_backend("memory", client=self.client)
+
+    def test_deferred_keys_are_retried(self):
+        names = ["fq%02d" % i for i in range(25)]
+        fqprofile.update_items("fastq", [(name, {"bases": 1}) for name in names],
+                               batch_size=10)
+        self.client.calls = {}
+        self.client.deferred = set()
+        found = fqprofile.get_items("fastq", names, batch_size=10)
+        self.assertEqual(sorted(found), names)
+        # Each batch defers its first keys once, and asks for them again.
+        self.assertEqual(self.client.calls["get_multi"], 6)
+
+    def test_query_pages(self):
+        names = ["fq%02d" % i for i in range(25)]
+        fqprofile.update_items("fastq", [(name, {"bases": 1}) for name in names])
+        # Batches shorter than a page, and pages that reach the limit.
+        for max_batch in (4, None):
+            self.client.max_batch = max_batch
+            pages = list(fqprofile.query_pages("fastq", page_size=10))
+            self.assertEqual(sorted(x.key.name for page in pages for x in page), names)
+            self.assertTrue(all(len(page) <= 10 for page in pages))
+
+    def test_excluded_properties(self):
+        fqprofile.update_items("fastq", [("a", {"most_abundant_sequence": "ACGT"})])
+        item = fqprofile.get_item("fastq", "a")
+        self.assertEqual(item["most_abundant_sequence"], "ACGT")
+        self.assertIn("most_abundant_sequence", item.exclude_from_indexes)
+
+    def test_transient_errors_are_retried(self):
+        from gcloud.exceptions import ServiceUnavailable
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ServiceUnavailable("unavailable")
+            return "done"
+        self.assertEqual(fqprofile.retry(flaky), "done")
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        from gcloud.exceptions import BadRequest
+        calls = []
+
+        def bad():
+            calls.append(1)
+            raise BadRequest("bad request")
+        self.assertRaises(BadRequest, fqprofile.retry, bad)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()